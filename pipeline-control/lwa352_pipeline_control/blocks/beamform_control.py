@@ -5,6 +5,8 @@ from .block_control_base import BlockControl
 from ..lwa352_utils import time_to_spectra
 
 class BeamformControl(BlockControl):
+    _gain_buf = None # Scratch buffer for gains needing dtype conversion
+
     def update_calibration_gains(self, beam_id, input_id, gains):
         """
         Update calibration gains for a single beam and input.
@@ -24,21 +26,24 @@ class BeamformControl(BlockControl):
         :type gains: numpy.array
 
         """
-        # We can't send a numpy array through JSON, so encode
-        # as a real-valued list with alternating real/imag entries.
-        # This allows the standard JSON messaging scheme to be used,
-        # But we could equally use binary strings (which would
-        # be much more efficient)
-        nchan = gains.shape[0]
-        gains_real = np.zeros(2*nchan, dtype=np.float32)
-        gains_real[0::2] = gains.real
-        gains_real[1::2] = gains.imag
+        # Send as a real-valued array with alternating real/imag entries.
+        # For complex64 input this is just a view of the existing buffer,
+        # and the array is sent as a binary blob rather than a JSON list.
+        # Other input types are converted into a reusable scratch buffer,
+        # which is safe since the command is encoded before we return.
+        gains = np.asarray(gains)
+        if gains.dtype != np.complex64 or not gains.flags.c_contiguous:
+            if self._gain_buf is None or self._gain_buf.shape != gains.shape:
+                self._gain_buf = np.empty(gains.shape, dtype=np.complex64)
+            np.copyto(self._gain_buf, gains, casting='unsafe')
+            gains = self._gain_buf
+        gains_real = gains.view(np.float32)
         return self._send_command(
             coeffs = {
                 'type': 'calgains',
                 'input_id': input_id,
                 'beam_id': beam_id,
-                'data': gains_real.tolist(),
+                'data': gains_real,
             }
         )
 
@@ -88,7 +93,7 @@ class BeamformControl(BlockControl):
         coeffs = {
             'type': 'beamcoeffs',
             'beam_id': beam_id,
-            'data': {'delays': delays.tolist(), 'amps': amps.tolist()},
+            'data': {'delays': delays, 'amps': amps},
             'load_sample': load_sample
         }
         self._log.debug("Command: %s" % str(coeffs))
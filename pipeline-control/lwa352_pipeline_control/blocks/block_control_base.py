@@ -1,3 +1,5 @@
+import contextlib
+
 class BlockControl():
     """
     A class for controlling bifrost correlator blocks via
@@ -59,6 +61,27 @@ class BlockControl():
             **kwargs,
         )
 
+    @contextlib.contextmanager
+    def batch(self):
+        """
+        A context manager which queues all commands issued within it and
+        sends them in as few etcd transactions as possible on exit. E.g.:
+
+        ``with ctrl.batch(): for b in beams: ctrl.update_delays(b, d)``
+
+        Commands issued in a batch don't wait for the block's response, and
+        return None. If an exception is raised, the queued commands are discarded.
+        A RuntimeError is raised on exit if the commands could not all be sent.
+        """
+        self._corr_interface.begin_batch()
+        try:
+            yield
+        except:
+            self._corr_interface.abort_batch()
+            raise
+        if not self._corr_interface.commit_batch():
+            raise RuntimeError("Failed to send batched commands")
+
     def get_bifrost_status(self, user_only=False):
         """
         Get the stats stored in this block's status key
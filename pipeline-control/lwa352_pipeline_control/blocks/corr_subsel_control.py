@@ -2,8 +2,9 @@ from .block_control_base import BlockControl
 import numpy as np
 
 class CorrSubselControl(BlockControl):
-    nvis_out = 4656
+    nvis_out = 4704
     def set_baseline_select(self, subsel):
-       subsel = np.array(subsel, dtype=np.int32)
+       # No copy if we were already given a suitable int32 array
+       subsel = np.ascontiguousarray(subsel, dtype=np.int32)
        assert subsel.shape == (self.nvis_out, 2, 2)
-       return self._send_command(subsel=subsel.tolist())
+       return self._send_command(baselines=subsel)
@@ -2,7 +2,14 @@ import argparse
 import time
 import sys
 import logging
-import simplejson as json
+import threading
+import concurrent.futures
+import base64
+import json
+import orjson
+import msgpack
+import numpy as np
+import blosc
 import etcd3 as etcd
 
 default_log = logging.getLogger(__name__)
@@ -13,6 +20,127 @@ logHandler = logging.StreamHandler(sys.stdout)
 logHandler.setFormatter(logFormat)
 default_log.addHandler(logHandler)
 
+#: Leading byte marking a command as MessagePack, rather than JSON, encoded.
+MSGPACK_PREFIX = b'\x01'
+
+#: etcd's default limit on the number of operations in a single transaction.
+ETCD_MAX_TXN_OPS = 128
+#: Maximum size, in bytes, of the commands sent in a single etcd transaction.
+#: This leaves headroom below etcd's default 1.5 MiB request size limit.
+ETCD_MAX_TXN_BYTES = 1024 * 1024
+
+def _json_loads(s):
+    """
+    Decode a JSON string (or bytes) with orjson, falling back to the
+    (slower, but more permissive) standard library decoder for
+    documents orjson rejects, such as those containing ``NaN`` values.
+
+    :param s: JSON document to decode
+    :type s: bytes or str
+
+    :return: The decoded object
+    """
+    try:
+        return orjson.loads(s)
+    except orjson.JSONDecodeError:
+        return json.loads(s)
+
+def _pack_ndarray(a):
+    """
+    Compress a numpy array for transmission in a command.
+
+    The array data are converted to little-endian and blosc-compressed, and
+    are returned alongside the array's data type and shape.
+
+    :param a: Array to encode
+    :type a: numpy.ndarray
+
+    :return: Dictionary with keys ``__nd__``, ``dtype``, ``shape``, and ``data``,
+        where ``data`` is the compressed array buffer
+    :rtype: dict
+
+    """
+    a = np.ascontiguousarray(a, dtype=a.dtype.newbyteorder('<'))
+    packed = blosc.compress_ptr(a.__array_interface__['data'][0], a.size,
+                                typesize=a.dtype.itemsize, cname='lz4',
+                                shuffle=blosc.SHUFFLE)
+    return {
+        '__nd__': 1,
+        'dtype': a.dtype.str,
+        'shape': list(a.shape),
+        'data': packed,
+    }
+
+def unpack_ndarrays(d):
+    """
+    Replace any binary-encoded numpy arrays (as produced by
+    ``_encode_ndarray`` or ``_encode_ndarray_msgpack``) in a decoded
+    command dictionary with the arrays they represent. This is the
+    inverse of the encoding, as applied by pipeline blocks to the commands
+    they receive. Only dictionary values are searched (recursively); lists
+    are left untouched.
+
+    :param d: Decoded command dictionary
+    :type d: dict
+
+    :return: Dictionary with encoded arrays replaced by ``numpy.ndarray`` objects
+    :rtype: dict
+    """
+    if d.get('__nd__', False):
+        data = d['data']
+        if not isinstance(data, bytes):
+            data = base64.b64decode(data)
+        buf = blosc.decompress(data, as_bytearray=True)
+        return np.frombuffer(buf, dtype=np.dtype(d['dtype'])).reshape(d['shape'])
+    for k, v in d.items():
+        if isinstance(v, dict):
+            d[k] = unpack_ndarrays(v)
+    return d
+
+def _encode_ndarray(a):
+    """
+    Encode a numpy array as a JSON-serializable dictionary, for use as
+    the ``default`` hook of the JSON encoder.
+
+    The array is compressed with ``_pack_ndarray``, and the compressed data
+    base64-encoded. This is far more compact (and faster to encode) than a
+    JSON list of numbers. Numpy scalars (which the encoder does not handle
+    natively) are returned as the equivalent Python scalar.
+
+    :param a: Array to encode
+    :type a: numpy.ndarray
+
+    :return: Dictionary with keys ``__nd__``, ``dtype``, ``shape``, and ``data``
+    :rtype: dict
+
+    """
+    if isinstance(a, np.generic):
+        return a.item()
+    if not isinstance(a, np.ndarray):
+        raise TypeError("Object of type %s is not JSON serializable" % type(a).__name__)
+    d = _pack_ndarray(a)
+    d['data'] = base64.b64encode(d['data']).decode()
+    return d
+
+def _encode_ndarray_msgpack(a):
+    """
+    As ``_encode_ndarray``, but for use as the ``default`` hook of the
+    MessagePack encoder, which can carry the compressed array data as
+    raw bytes.
+
+    :param a: Array to encode
+    :type a: numpy.ndarray
+
+    :return: Dictionary with keys ``__nd__``, ``dtype``, ``shape``, and ``data``
+    :rtype: dict
+
+    """
+    if isinstance(a, np.generic):
+        return a.item()
+    if not isinstance(a, np.ndarray):
+        raise TypeError("Object of type %s is not MessagePack serializable" % type(a).__name__)
+    return _pack_ndarray(a)
+
 class EtcdCorrControl():
     """
     **Description**
@@ -70,24 +198,75 @@ class EtcdCorrControl():
     :type log: logging.Logger
 
     :param simulated: If True, don't send messages over etcd, just
-        return their JSON strings.
+        return their encodings.
     :type simulated: bool
 
+    :param wire_format: The encoding used for commands. Either 'json' or
+        'msgpack'. MessagePack-encoded commands are smaller and faster to
+        encode and decode, particularly when they carry numeric arrays, but
+        are not human-readable. Responses and status are always JSON.
+    :type wire_format: string
+
+    :param grpc_timeout: Deadline, in seconds, applied by the etcd client to
+        each of its requests (e.g. command writes and status reads). If None,
+        requests may block indefinitely if the etcd server is unresponsive.
+    :type grpc_timeout: float
+
+    :param grpc_compression: If True, gzip-compress requests sent to the
+        etcd server. This reduces the network traffic generated by large
+        commands, but requires an etcd server which accepts gzip-compressed
+        requests. It is ignored (with a warning) if the installed etcd3
+        library does not allow gRPC channel options to be set.
+    :type grpc_compression: bool
+
     """
     def __init__(self, etcdhost='etcdhost', keyroot_cmd='/cmd/corr/x',
                  keyroot_mon='/mon/corr/x', keyroot_resp='/resp/corr/x',
-                 log=default_log, simulated=False):
+                 log=default_log, simulated=False, wire_format='json',
+                 grpc_timeout=10.0, grpc_compression=False):
         self.keyroot_cmd = keyroot_cmd
         self.keyroot_mon = keyroot_mon
         self.keyroot_resp = keyroot_resp
         self.etcdhost = etcdhost
         self.log = log
         self.simulated = simulated
+        if wire_format not in ['json', 'msgpack']:
+            raise ValueError("Unknown wire format '%s'" % wire_format)
+        self.wire_format = wire_format
+        # Caches of (host, pipeline, block, inst_id) -> key string
+        self._cmd_key_cache = {}
+        self._resp_key_cache = {}
+        self._mon_key_cache = {}
+        # Cache of (cmd, block) -> pre-encoded start of a JSON command
+        self._cmd_prefix_cache = {}
+        # Response watches are created once per response key, and persist.
+        # Responses are dispatched to waiting commands by sequence ID.
+        self._response_lock = threading.Lock()
+        self._response_watches = {} # resp_key -> watch ID
+        self._pending_responses = {} # sequence_id -> [Event, response dict]
+        # Per-thread store of commands queued by begin_batch()
+        self._batch = threading.local()
+        # Commands sent by send_command_async are encoded and sent by a
+        # single worker thread, so they stay in order.
+        self._async_executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        self._async_lock = threading.Lock()
+        self._async_futures = []
         if simulated:
             self.ec = None
         else:
             try:
-                self.ec = etcd.client(self.etcdhost)
+                self.ec = None
+                if grpc_compression:
+                    # 2 == grpc.Compression.Gzip
+                    grpc_options = [('grpc.default_compression_algorithm', 2)]
+                    try:
+                        self.ec = etcd.client(self.etcdhost, timeout=grpc_timeout,
+                                              grpc_options=grpc_options)
+                    except TypeError:
+                        log.warning('etcd3 library does not support gRPC options. '
+                                    'Not using compression')
+                if self.ec is None:
+                    self.ec = etcd.client(self.etcdhost, timeout=grpc_timeout)
             except:
                 log.error('Failed to connect to ETCD host %s' % self.etcdhost)
                 raise
@@ -114,8 +293,12 @@ class EtcdCorrControl():
 
         """
 
-        key = self._get_key(host, pipeline, block, inst_id)
-        return self.keyroot_cmd + key
+        k = (host, pipeline, block, inst_id)
+        key = self._cmd_key_cache.get(k, None)
+        if key is None:
+            key = self.keyroot_cmd + self._get_key(host, pipeline, block, inst_id)
+            self._cmd_key_cache[k] = key
+        return key
 
     def _get_resp_key(self, host, pipeline, block, inst_id):
         """
@@ -139,8 +322,12 @@ class EtcdCorrControl():
 
         """
 
-        key = self._get_key(host, pipeline, block, inst_id)
-        return self.keyroot_resp + key
+        k = (host, pipeline, block, inst_id)
+        key = self._resp_key_cache.get(k, None)
+        if key is None:
+            key = self.keyroot_resp + self._get_key(host, pipeline, block, inst_id)
+            self._resp_key_cache[k] = key
+        return key
 
     def _get_key(self, host, pipeline, block, inst_id):
         """
@@ -193,8 +380,12 @@ class EtcdCorrControl():
         :rtype: string
 
         """
-        key = self._get_key(host, pipeline, block, inst_id)
-        return self.keyroot_mon + key
+        k = (host, pipeline, block, inst_id)
+        key = self._mon_key_cache.get(k, None)
+        if key is None:
+            key = self.keyroot_mon + self._get_key(host, pipeline, block, inst_id)
+            self._mon_key_cache[k] = key
+        return key
 
     def send_command(self, host, pipeline=None, block=None, inst_id=None,
             cmd='update', timeout=10.0, **kwargs):
@@ -221,11 +412,16 @@ class EtcdCorrControl():
         :param **kwargs: Keyword arguments are used to specify which
             control values should be set. Any key names and JSON-serializable
             values are allowed. These should match the key names expected
-            by the processing block being targeted.
-        :type **kwargs: Any JSON-serializable values
+            by the processing block being targeted. Numpy arrays are sent
+            as compressed binary buffers (see ``_encode_ndarray``).
+        :type **kwargs: Any JSON-serializable values, or numpy arrays
 
-        If ``self.simulated=True``, returns the JSON string which would be sent over
-        etcd.
+        If ``self.simulated=True``, returns the JSON-encoded bytes which would be
+        sent over etcd.
+
+        If a batch has been started with ``begin_batch``, the command is
+        queued rather than sent, and None is returned. Queued commands
+        are sent by ``commit_batch``.
 
         """
 
@@ -246,42 +442,224 @@ class EtcdCorrControl():
         if self.simulated:
             return command_json
 
-        self._response_received = False
-        self._response = None
-
-        def response_callback(watchresponse):
-            for event in watchresponse.events:
-                self.log.debug("Got command response")
-                try:
-                    response_dict = json.loads(event.value.decode())
-                except:
-                    self.log.exception("Response JSON decode error")
-                    continue
-                self.log.debug("Response: %s" % response_dict)
-                resp_id = response_dict.get("id", None)
-                if resp_id == sequence_id:
-                    self._response = response_dict
-                    self._response_received = True
-                else:
-                    self.log.debug("Seq ID %s didn't match expected (%s)" % (resp_id, sequence_id))
-
-        # Begin watching response channel and then send message
-        watch_id = self.ec.add_watch_callback(resp_key, response_callback)
-        # send command
-        self.ec.put(cmd_key, command_json)
-        starttime = time.time()
-        while(True):
-            if self._response_received:
-                self.ec.cancel_watch(watch_id)
-                status = self._response['val']['status']
-                if status != 'normal':
-                    self.log.info("Command status returned: '%s'" % status)
-                return self._response['val']['response']
-            if time.time() > starttime + timeout:
-                self.ec.cancel_watch(watch_id)
-                self.log.error("host %s (pipeline %s) failed to respond to etcd command!" % (host, str(pipeline)))
-                raise RuntimeError
-            time.sleep(0.001)
+        batch = getattr(self._batch, 'puts', None)
+        if batch is not None:
+            batch.setdefault(cmd_key, []).append(command_json)
+            return
+
+        pending = [threading.Event(), None]
+        with self._response_lock:
+            self._pending_responses[sequence_id] = pending
+            if resp_key not in self._response_watches:
+                self._response_watches[resp_key] = self.ec.add_watch_callback(
+                                                       resp_key,
+                                                       self._response_callback,
+                                                   )
+        try:
+            # send command, and wait for the watch callback to wake us up
+            self.ec.put(cmd_key, command_json)
+            got_response = pending[0].wait(timeout)
+        finally:
+            with self._response_lock:
+                self._pending_responses.pop(sequence_id, None)
+        if not got_response:
+            self.log.error("host %s (pipeline %s) failed to respond to etcd command!" % (host, str(pipeline)))
+            raise RuntimeError
+        response = pending[1]
+        status = response['val']['status']
+        if status != 'normal':
+            self.log.info("Command status returned: '%s'" % status)
+        return response['val']['response']
+
+    def send_command_async(self, host, pipeline=None, block=None, inst_id=None,
+            cmd='update', **kwargs):
+        """
+        Send a command to a processing block without waiting for it to be
+        encoded or sent, and without waiting for a response. Arguments are as
+        for ``send_command``.
+
+        Commands are encoded and written to etcd in the order they were
+        issued, by a background thread. Any arrays passed as arguments
+        should not be modified until the command has been sent.
+        Use ``flush`` to wait for all commands to be sent.
+
+        :return: A Future whose result is True if the command was sent
+            successfully, and False otherwise. If ``self.simulated=True``, the
+            result is the encoded command, as returned by ``send_command``.
+        :rtype: concurrent.futures.Future
+        """
+        future = self._async_executor.submit(self._send_command_nowait,
+                                             host, pipeline, block, inst_id,
+                                             cmd, kwargs)
+        with self._async_lock:
+            self._async_futures = [f for f in self._async_futures if not f.done()]
+            self._async_futures += [future]
+        return future
+
+    def _send_command_nowait(self, host, pipeline, block, inst_id, cmd, kwargs):
+        """
+        Encode and send a command, without waiting for a response.
+        Used by ``send_command_async``.
+        """
+        cmd_key = self._get_cmd_key(host, pipeline, block, inst_id)
+        timestamp = time.time()
+        sequence_id = str(int(timestamp * 1e6))
+        command_json = self._format_command(sequence_id, timestamp, block, cmd,
+                                            kwargs=kwargs)
+        if command_json is None:
+            return False
+        if self.simulated:
+            return command_json
+        try:
+            self.ec.put(cmd_key, command_json)
+        except:
+            self.log.exception("Failed to send command to %s" % cmd_key)
+            return False
+        return True
+
+    def flush(self, timeout=None):
+        """
+        Wait for all commands issued with ``send_command_async`` to be sent.
+
+        :param timeout: Maximum time, in seconds, to wait. If None, wait
+            indefinitely.
+        :type timeout: float
+
+        :return: True if all commands were sent successfully, False otherwise.
+        :rtype: bool
+        """
+        with self._async_lock:
+            futures = self._async_futures
+            self._async_futures = []
+        done, not_done = concurrent.futures.wait(futures, timeout=timeout)
+        if not_done:
+            self.log.error("%d commands were not sent before timeout" % len(not_done))
+            with self._async_lock:
+                self._async_futures += list(not_done)
+            return False
+        return all([f.result() is not False for f in done])
+
+    def begin_batch(self):
+        """
+        Start queuing commands issued by this thread with ``send_command``,
+        rather than sending them immediately. Queued commands are sent in
+        as few etcd transactions as possible by ``commit_batch``. Batches
+        cannot be nested.
+
+        Batched commands are sent without waiting for responses. Multiple
+        commands destined for the same processing block are sent as a single
+        JSON list of commands, which the block processes in order.
+        """
+        self._batch.puts = {}
+
+    def abort_batch(self):
+        """
+        Discard any commands queued since ``begin_batch`` and return to
+        sending commands immediately.
+        """
+        self._batch.puts = None
+
+    def _join_commands(self, cmds):
+        """
+        Combine a list of encoded commands into a single value which a
+        processing block will decode as a list of commands.
+        """
+        if len(cmds) == 1:
+            return cmds[0]
+        elif self.wire_format == 'msgpack':
+            # A MessagePack array is just a header followed by its
+            # already-packed elements
+            return MSGPACK_PREFIX + msgpack.Packer().pack_array_header(len(cmds)) \
+                   + b''.join([c[len(MSGPACK_PREFIX):] for c in cmds])
+        else:
+            return b'[' + b','.join(cmds) + b']'
+
+    def commit_batch(self):
+        """
+        Send all commands queued since ``begin_batch``, and return to
+        sending commands immediately.
+
+        Commands are sent in as few etcd transactions as possible, each
+        containing at most ``ETCD_MAX_TXN_OPS`` writes and (unless a single
+        command is larger) ``ETCD_MAX_TXN_BYTES`` of data. Commands for
+        each processing block are delivered in the order they were issued.
+        If a transaction fails, no further transactions are sent, but
+        those which have already succeeded are not undone.
+
+        :return: True if all transactions succeeded, False otherwise.
+        :rtype: bool
+        """
+        batch = getattr(self._batch, 'puts', None)
+        self._batch.puts = None
+        if not batch:
+            return True
+        # Combine the commands for each key into as few values as the
+        # transaction size limit allows
+        vals = []
+        for key, cmds in batch.items():
+            chunk = []
+            chunk_size = 0
+            for c in cmds:
+                if chunk and chunk_size + len(c) > ETCD_MAX_TXN_BYTES:
+                    vals += [(key, self._join_commands(chunk))]
+                    chunk = []
+                    chunk_size = 0
+                chunk += [c]
+                chunk_size += len(c)
+            vals += [(key, self._join_commands(chunk))]
+        # Group the values into transactions. A key may only be written
+        # once per transaction, so later values for a key go in a later one.
+        txns = []
+        txn_keys = set()
+        txn_size = 0
+        for key, val in vals:
+            if not txns or key in txn_keys or len(txns[-1]) >= ETCD_MAX_TXN_OPS \
+               or (txn_size + len(val) > ETCD_MAX_TXN_BYTES and txn_size > 0):
+                txns += [[]]
+                txn_keys = set()
+                txn_size = 0
+            txns[-1] += [self.ec.transactions.put(key, val)]
+            txn_keys.add(key)
+            txn_size += len(val)
+        nsent = 0
+        for ops in txns:
+            try:
+                ok, _ = self.ec.transaction(compare=[], success=ops, failure=[])
+            except:
+                self.log.exception("Failed to send batch of %d etcd commands" % len(ops))
+                ok = False
+            if not ok:
+                self.log.error("Sent %d of %d etcd command transactions" % (nsent, len(txns)))
+                return False
+            nsent += 1
+        return True
+
+    def _response_callback(self, watchresponse):
+        """
+        Callback for the persistent response key watches. Decodes each
+        response and, if a command with a matching sequence ID is waiting,
+        hands over the response and wakes the waiting caller.
+
+        :param watchresponse: A WatchResponse object used by the etcd
+            `add_watch_callback` as the calling argument.
+        :type watchresponse: WatchResponse
+        """
+        for event in watchresponse.events:
+            self.log.debug("Got command response")
+            try:
+                response_dict = _json_loads(event.value)
+            except:
+                self.log.exception("Response JSON decode error")
+                continue
+            self.log.debug("Response: %s" % response_dict)
+            resp_id = response_dict.get("id", None)
+            with self._response_lock:
+                pending = self._pending_responses.get(resp_id, None)
+            if pending is None:
+                self.log.debug("Seq ID %s didn't match any pending command" % resp_id)
+                continue
+            pending[1] = response_dict
+            pending[0].set()
 
     def _format_command(self, sequence_id, timestamp, block, cmd, kwargs={}):
         """
@@ -302,23 +680,40 @@ class EtcdCorrControl():
         :param kwargs: The ``kwargs`` command field
         :type kwargs: dict
 
-        :return: JSON-encoded command string to be sent. Returns None if there
-            is an enoding error.
+        :return: Encoded command bytes to be sent, in this instance's
+            ``wire_format``. Returns None if there is an enoding error.
         """
-        command_dict = {
-            "cmd": cmd,
-            "val": {
-                "block": block,
-                "timestamp": timestamp,
-                "kwargs": kwargs,
-                },
-            "id": sequence_id,
-        }
         try:
-            command_json = json.dumps(command_dict)
+            if self.wire_format == 'msgpack':
+                command_dict = {
+                    "cmd": cmd,
+                    "val": {
+                        "block": block,
+                        "timestamp": timestamp,
+                        "kwargs": kwargs,
+                        },
+                    "id": sequence_id,
+                }
+                return MSGPACK_PREFIX + msgpack.packb(command_dict, use_bin_type=True,
+                                                     default=_encode_ndarray_msgpack)
+            # Only the timestamp, kwargs and ID vary between commands to the
+            # same block, so splice these into a cached encoding of the rest
+            # of the command, rather than building and encoding the full
+            # command dictionary each time.
+            prefix = self._cmd_prefix_cache.get((cmd, block), None)
+            if prefix is None:
+                # b'{"cmd":<cmd>,"val":{"block":<block>}}' -> strip trailing '}}'
+                prefix = orjson.dumps({"cmd": cmd, "val": {"block": block}})[:-2]
+                self._cmd_prefix_cache[(cmd, block)] = prefix
+            # Arrays are deliberately left to the ``default`` hook rather than
+            # OPT_SERIALIZE_NUMPY, so that they are sent as compressed binary
+            # rather than as (much larger) JSON lists of numbers.
+            command_json = prefix + b',"timestamp":' + orjson.dumps(timestamp) \
+                           + b',"kwargs":' + orjson.dumps(kwargs, default=_encode_ndarray) \
+                           + b'},"id":' + orjson.dumps(sequence_id) + b'}'
             return command_json
         except:
-            self.log.exception("Failed to JSON-encode command")
+            self.log.exception("Failed to encode command")
             return
 
     def get_status(self, host, pipeline, block, inst_id, user_only=True):
@@ -356,7 +751,7 @@ class EtcdCorrControl():
         if val is None:
             self.log.warning("Etcd key %s returned no data" % key)
             return val
-        val = json.loads(val)
+        val = _json_loads(val)
         if user_only:
             return val.get("stats", {})
         else:
@@ -7,7 +7,11 @@ def time_to_spectra(t):
     Given a UNIX time, return a spectra count
     since the UNIX epoch.
     """
-    sample_number = int(t * FS_HZ)
+    # t * FS_HZ is ~3e17 for present-day times, which is beyond the
+    # exact-integer range of a double. Keep the whole seconds in integer
+    # arithmetic and only use floating point for the fractional part.
+    t_sec = int(t)
+    sample_number = t_sec * FS_HZ + int((t - t_sec) * FS_HZ)
     spectra_number = sample_number // (2*NCHAN)
     return spectra_number
 
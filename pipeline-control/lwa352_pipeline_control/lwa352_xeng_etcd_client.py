@@ -7,10 +7,13 @@ import json
 import threading
 import numpy as np
 import etcd3
+import msgpack
 import logging
 import netifaces
 import subprocess
 
+from .etcd_control import MSGPACK_PREFIX, unpack_ndarrays
+
 PIPELINE_COMMAND = "lwa352-pipeline.py" # used for 'killall'
 # DEFAULT PIPELINE SETTINGS
 NCHAN = 96
@@ -167,20 +170,25 @@ class LwaXengineEtcdClient():
         """
         A callback executed whenever this block's command key is modified.
         
-        This callback JSON decodes the key contents, and passes the
-        resulting dictionary to ``_process_commands``.
+        This callback decodes the key contents, which may be a single
+        command or a list of commands, and executes each command in turn
+        with ``_process_command``.
 
         :param watchresponse: A WatchResponse object used by the etcd
             `add_watch_prefix_callback` as the calling argument.
         :type watchresponse: WatchResponse
 
-        :return: True if command was processed successfully, False otherwise.
+        :return: True if all commands were processed successfully, False otherwise.
         """
+        ok = True
         for event in watchresponse.events:
             self.logger.debug("Got command: %s" % event.value)
             try:
-                command_dict = json.loads(event.value.decode())
-            except json.JSONDecodeError:
+                if event.value[:1] == MSGPACK_PREFIX:
+                    command_dict = msgpack.unpackb(event.value[1:], raw=False)
+                else:
+                    command_dict = json.loads(event.value.decode())
+            except ValueError:
                 err = "JSON decode error"
                 self.logger.error(err)
                 # If decode fails, we don't even have a command ID, so send
@@ -188,94 +196,118 @@ class LwaXengineEtcdClient():
                 self._send_command_response("Unknown", False, err)
                 return False
             self.logger.debug("Decoded command: %s" % command_dict)
+            # Batched commands arrive as a list of commands
+            if not isinstance(command_dict, list):
+                command_dict = [command_dict]
+            for cmd in command_dict:
+                ok = self._process_command(cmd) and ok
+        return ok
+
+    def _process_command(self, command_dict):
+        """
+        Execute a single decoded command, and send a response.
 
-            for field in ["id", "cmd", "val"]:
-                if not field in command_dict:
-                    err = "No '%s' field in message" % field
-                    self.logger.error(err)
-                    self._send_command_response("Unknown", False, err)
-                    return False
+        :param command_dict: Decoded command
+        :type command_dict: dict
 
-            seq_id = command_dict.get("id", "Unknown")
-            if not isinstance(seq_id, str):
-                err = "Sequence ID not string"
+        :return: True if command was processed successfully, False otherwise.
+        """
+        if not isinstance(command_dict, dict):
+            err = "Bad command format"
+            self.logger.error(err)
+            self._send_command_response("Unknown", False, err)
+            return False
+
+        for field in ["id", "cmd", "val"]:
+            if not field in command_dict:
+                err = "No '%s' field in message" % field
                 self.logger.error(err)
                 self._send_command_response("Unknown", False, err)
                 return False
 
-            try:
-                block = command_dict["val"].get("block", None)
-            except:
-                block = None
-            if block is None:
-                self.logger.error("Received val string with no 'block' key!")
-                err = "Bad command format"
-                self._send_command_response(seq_id, False, err)
-                return False
-
-            command = command_dict.get("cmd", None)
-            if command is None:
-                self.logger.error("Received command string with no 'command' key!")
-                err = "Bad command format"
-                self._send_command_response(seq_id, False, err)
-                return False
-
-            # Only allow commands to reference blocks which are in the
-            # Fengine.blocks dict, or Fengine itself
-            if block == "xctrl":
-                block_obj = self.xctrl
-            else:
-                self.logger.error("Received block %s not allowed!" % block)
-                err = "Wrong block"
-                self._send_command_response(seq_id, False, err)
-                return False
+        seq_id = command_dict.get("id", "Unknown")
+        if not isinstance(seq_id, str):
+            err = "Sequence ID not string"
+            self.logger.error(err)
+            self._send_command_response("Unknown", False, err)
+            return False
 
-            # Check command is valid
-            if command.startswith("_"):
-                self.logger.error("Received command starting with underscore!")
-                err = "Command not allowed"
-                self._send_command_response(seq_id, False, err)
-                return False
-            if not (hasattr(block_obj, command) and callable(getattr(block_obj, command))):
-                self.logger.error("Received command invalid!")
-                err = "Command invalid"
-                self._send_command_response(seq_id, False, err)
-                return False
-            else:
-                cmd_method = getattr(block_obj, command)
-            # Process command
-            cmd_kwargs = command_dict["val"].get("kwargs", {})
-            ok = True
-            try:
-                #if self.is_polling():
-                #    self._poll_pause_trigger.set()
-                #    self._poll_is_paused.wait(timeout=10)
-                resp = cmd_method(**cmd_kwargs)
-                #self._poll_pause_trigger.clear()
-            except TypeError:
-                ok = False
-                err = "Command arguments invalid"
-                self.logger.exception(err)
-            except:
-                ok = False
-                err = "Command failed"
-                self.logger.exception(err)
-            if not ok:
-                self._send_command_response(seq_id, ok, err)
-                self.logger.error("Responded to command '%s' (ID %s): %s" % (command, seq_id, err))
-                return False
-            try:
-                if isinstance(resp, np.ndarray):
-                    resp = resp.tolist()
-                # Check we will be able to encode the response
-                test_encode = json.dumps(resp)
-            except:
-                self.logger.exception("Failed to encode JSON")
-                resp = "JSON_ERROR"
-            self._send_command_response(seq_id, ok, resp)
-            self.logger.info("Responded to command '%s' (ID %s): OK? %s" % (command, seq_id, ok))
-            self.logger.debug("Responded to command '%s' (ID %s): %s" % (command, seq_id, resp))
-            return ok
+        try:
+            block = command_dict["val"].get("block", None)
+        except:
+            block = None
+        if block is None:
+            self.logger.error("Received val string with no 'block' key!")
+            err = "Bad command format"
+            self._send_command_response(seq_id, False, err)
+            return False
+
+        command = command_dict.get("cmd", None)
+        if command is None:
+            self.logger.error("Received command string with no 'command' key!")
+            err = "Bad command format"
+            self._send_command_response(seq_id, False, err)
+            return False
+
+        # Only allow commands to reference blocks which are in the
+        # Fengine.blocks dict, or Fengine itself
+        if block == "xctrl":
+            block_obj = self.xctrl
+        else:
+            self.logger.error("Received block %s not allowed!" % block)
+            err = "Wrong block"
+            self._send_command_response(seq_id, False, err)
+            return False
+
+        # Check command is valid
+        if command.startswith("_"):
+            self.logger.error("Received command starting with underscore!")
+            err = "Command not allowed"
+            self._send_command_response(seq_id, False, err)
+            return False
+        if not (hasattr(block_obj, command) and callable(getattr(block_obj, command))):
+            self.logger.error("Received command invalid!")
+            err = "Command invalid"
+            self._send_command_response(seq_id, False, err)
+            return False
+        else:
+            cmd_method = getattr(block_obj, command)
+        # Process command
+        cmd_kwargs = command_dict["val"].get("kwargs", {})
+        ok = True
+        try:
+            #if self.is_polling():
+            #    self._poll_pause_trigger.set()
+            #    self._poll_is_paused.wait(timeout=10)
+            # Numpy arrays may be sent binary-encoded
+            if isinstance(cmd_kwargs, dict):
+                cmd_kwargs = unpack_ndarrays(cmd_kwargs)
+            resp = cmd_method(**cmd_kwargs)
+            #self._poll_pause_trigger.clear()
+        except TypeError:
+            ok = False
+            err = "Command arguments invalid"
+            self.logger.exception(err)
+        except:
+            ok = False
+            err = "Command failed"
+            self.logger.exception(err)
+        if not ok:
+            self._send_command_response(seq_id, ok, err)
+            self.logger.error("Responded to command '%s' (ID %s): %s" % (command, seq_id, err))
+            return False
+        try:
+            if isinstance(resp, np.ndarray):
+                resp = resp.tolist()
+            # Check we will be able to encode the response
+            test_encode = json.dumps(resp)
+        except:
+            self.logger.exception("Failed to encode JSON")
+            resp = "JSON_ERROR"
+        self._send_command_response(seq_id, ok, resp)
+        self.logger.info("Responded to command '%s' (ID %s): OK? %s" % (command, seq_id, ok))
+        self.logger.debug("Responded to command '%s' (ID %s): %s" % (command, seq_id, resp))
+        return ok
 
     def __del__(self):
         self.stop_command_watch()
@@ -2,16 +2,22 @@
 
 import argparse
 import socket
-import glob
 import os
 import time
 import re
+from concurrent.futures import ThreadPoolExecutor
 
-import simplejson as json
+import orjson
 import etcd3 as etcd
 from bifrost.proclog import load_by_pid
 
 BIFROST_STATS_BASE_DIR = '/dev/shm/bifrost/'
+# etcd's default limit on the number of operations in a single transaction
+ETCD_MAX_TXN_OPS = 128
+# Published keys expire if not refreshed for this many poll periods
+LEASE_POLLS = 3
+# Number of processes whose proclogs are read concurrently
+POLL_THREADS = 8
 
 def get_command_line(pid):
     """
@@ -22,85 +28,152 @@ def get_command_line(pid):
 
     cmd = ''
     try:
-        with open('/proc/%i/cmdline' % pid, 'r') as fh:
-            cmd = fh.read()
-            cmd = cmd.replace('\0', ' ')
-            fh.close()
+        with open('/proc/%i/cmdline' % pid, 'rb') as fh:
+            cmd = fh.read().replace(b'\0', b' ').decode()
     except IOError:
         pass
     return cmd
 
-def poll(base_dir):
-    ## Find all running processes
-    pidDirs = glob.glob(os.path.join(base_dir, '*'))
-    pidDirs.sort()
+# Command lines of running processes, keyed by (PID, inode of the process's
+# proclog directory), so that a reused PID is not mistaken for an old process
+_command_line_cache = {}
 
-    ## Load the data
+def _process_pid(pn, pidDir):
+    """
+    Load the proclog data of the process with proclog directory ``pidDir``,
+    the ``pn``-th such directory, and return a dictionary of stats for each
+    of its blocks.
+    """
     blockList = {}
-    for pn, pidDir in enumerate(pidDirs):
-        pid = int(os.path.basename(pidDir), 10)
-        contents = load_by_pid(pid)
+    pid = int(pidDir.name, 10)
+    contents = load_by_pid(pid)
 
+    cache_key = (pid, pidDir.inode())
+    cmd = _command_line_cache.get(cache_key, '')
+    if cmd == '':
         cmd = get_command_line(pid)
         if cmd == '':
+            return blockList
+        _command_line_cache[cache_key] = cmd
+
+    for block in contents.keys():
+        try:
+            log = contents[block]['bind']
+            cr = log['core0']
+        except KeyError:
             continue
 
-        for block in contents.keys():
-            try:
-                log = contents[block]['bind']
-                cr = log['core0']
-            except KeyError:
-                continue
-
-            try:
-                pipeline_id = contents['block']['id']
-            except KeyError:
-                pipeline_id = pn
-
-            try:
-                log = contents[block]['perf']
-                ac = max([0.0, log['acquire_time']])
-                pr = max([0.0, log['process_time']])
-                re = max([0.0, log['reserve_time']])
-                gb = max([0.0, log.get('gbps', 0.0)])
-            except KeyError:
-                ac, pr, re, gb = 0.0, 0.0, 0.0, 0.0
-
-            blockList['%i-%s' % (pipeline_id, block)] = {
-                'pid': pid, 'name':block, 'cmd': cmd, 'core': cr,
-                'acquire': ac, 'process': pr, 'reserve': re, 'total':ac+pr+re,
-                'gbps':gb, 'time':time.time()}
-
-            try:
-                log = contents[block]['sequence0']
-                blockList['%i-%s' % (pipeline_id, block)].update(log)
-            except:
-                pass
-
-
-            # Get User stats
-            try:
-                if 'stats' in contents[block]:
-                    log = contents[block]['stats']
-                    for k, v in log.items():
-                        if v == 'True':
-                            log[k] = True
-                        elif v == 'False':
-                            log[k] = False
-                    blockList['%i-%s' % (pipeline_id, block)]['stats'] = log
-            except:
-                print("Error parsing stats")
+        try:
+            pipeline_id = contents['block']['id']
+        except KeyError:
+            pipeline_id = pn
+
+        try:
+            log = contents[block]['perf']
+            ac = max([0.0, log['acquire_time']])
+            pr = max([0.0, log['process_time']])
+            re = max([0.0, log['reserve_time']])
+            gb = max([0.0, log.get('gbps', 0.0)])
+        except KeyError:
+            ac, pr, re, gb = 0.0, 0.0, 0.0, 0.0
+
+        blockList['%i-%s' % (pipeline_id, block)] = {
+            'pid': pid, 'name':block, 'cmd': cmd, 'core': cr,
+            'acquire': ac, 'process': pr, 'reserve': re, 'total':ac+pr+re,
+            'gbps':gb, 'time':time.time()}
+
+        try:
+            log = contents[block]['sequence0']
+            blockList['%i-%s' % (pipeline_id, block)].update(log)
+        except:
+            pass
+
+
+        # Get User stats
+        try:
+            if 'stats' in contents[block]:
+                log = contents[block]['stats']
+                for k, v in log.items():
+                    if v == 'True':
+                        log[k] = True
+                    elif v == 'False':
+                        log[k] = False
+                blockList['%i-%s' % (pipeline_id, block)]['stats'] = log
+        except:
+            print("Error parsing stats")
+
+    return blockList
+
+def poll(base_dir, executor):
+    """
+    Read the proclogs of all running bifrost processes, using ``executor``
+    (a concurrent.futures.Executor) to handle several processes at once.
+    Return the time of the poll, and a dictionary of stats for each block.
+    """
+    ## Find all running processes
+    with os.scandir(base_dir) as it:
+        pidDirs = sorted((e for e in it if e.name.isdigit()), key=lambda e: e.name)
+
+    ## Forget command lines of processes which have gone away
+    live = set((int(e.name), e.inode()) for e in pidDirs)
+    for key in list(_command_line_cache.keys()):
+        if key not in live:
+            del _command_line_cache[key]
+
+    ## Load the data.  This is dominated by file reads, so do it for several
+    ## processes at once.  Each process only touches its own command line
+    ## cache entry.
+    blockList = {}
+    for pidBlocks in executor.map(_process_pid, range(len(pidDirs)), pidDirs):
+        blockList.update(pidBlocks)
 
     return time.time(), blockList
 
+def refresh_lease(ec, lease, ttl):
+    """
+    Refresh an etcd lease, or create a new one if there is no existing
+    lease, or the existing one has expired.
+    """
+    if lease is not None:
+        try:
+            if lease.refresh()[0].TTL > 0:
+                return lease
+        except Exception:
+            pass
+    return ec.lease(ttl)
+
+def send_transaction(ec, ops, retries=1):
+    """
+    Send a list of etcd operations in a single transaction, retrying
+    up to ``retries`` times if it fails. Return True if the
+    transaction succeeded.
+    """
+    for i in range(retries + 1):
+        try:
+            ok, _ = ec.transaction(compare=[], success=ops, failure=[])
+            if ok:
+                return True
+        except Exception as e:
+            print("etcd transaction failed: %s" % e)
+    return False
+
 def main(args):
    ec = etcd.client(args.etcdhost)
    last_poll = 0
+   # All keys are attached to a lease, so that they are removed if this
+   # bridge stops updating them
+   lease = None
+   published = set()
+   # Worker threads are reused from poll to poll
+   executor = ThreadPoolExecutor(max_workers=POLL_THREADS)
    while True:
        try:
            wait_time = max(0, last_poll + args.polltime - time.time())
            time.sleep(wait_time)
-           last_poll, d = poll(BIFROST_STATS_BASE_DIR)
+           last_poll, d = poll(BIFROST_STATS_BASE_DIR, executor)
+           lease = refresh_lease(ec, lease, LEASE_POLLS * args.polltime)
+           keys = set()
+           puts = []
            for k, v in d.items():
                pipeline_id, block = k.split('-')
                # If the block name ends in _<number> (which seem to be how
@@ -123,10 +196,24 @@ def main(args):
                           block=block,
                           block_id=block_id,
                       )
-               ec.put(ekey, json.dumps(v))
+               puts.append((ekey, ec.transactions.put(ekey, orjson.dumps(v), lease=lease)))
+               keys.add(ekey)
+           # Remove the keys of blocks which are no longer running
+           for ekey in published - keys:
+               puts.append((ekey, ec.transactions.delete(ekey)))
+           published = keys
+           # Publish all keys in as few round trips as possible
+           for i in range(0, len(puts), ETCD_MAX_TXN_OPS):
+               txn = puts[i:i+ETCD_MAX_TXN_OPS]
+               if not send_transaction(ec, [op for ekey, op in txn]):
+                   print("Failed to publish %d etcd keys" % len(txn))
+                   # Keep any keys which may not have been deleted, so
+                   # that deleting them is retried on the next poll
+                   published.update([ekey for ekey, op in txn])
            
        except KeyboardInterrupt:
            break
+   executor.shutdown()
 
 
 if __name__ == "__main__":
@@ -58,9 +58,21 @@ inline void gpuAssert(cudaError_t code, const char *file, int line, bool abort=t
 //  out_block[1] = out_i;
 //}
 
-void beamform_cpu(float *weights, char *in, float *out, int npols, int nchans, int nbeams)
+/* Convert a 4-bit two's complement value (held in the low
+ * nibble of v) to a float
+ */
+__host__ __device__ __forceinline__
+float nibble_to_float(int v)
+{
+  return (float)(((v & 0xf) ^ 8) - 8);
+}
+
+/* CPU reference implementation of the kernel below.
+ * Input data are 4+4 bit complex, one byte per sample, with the real
+ * part in the high nibble.
+ */
+void beamform_cpu(float *weights, unsigned char *in, float *out, int npols, int nchans, int nbeams)
 {
-  //int nbeams = blockDim.y;
   int b;
   int c;
   int t;
@@ -68,22 +80,24 @@ void beamform_cpu(float *weights, char *in, float *out, int npols, int nchans, i
   int p;
   float out_r[NBEAMS];
   float out_i[NBEAMS];
-  char pr, pi;
+  float pr, pi;
   float wr, wi;
   for(t=0; t<NTIMES; t++){
     for(c=0; c<NCHANS; c++){
-      char *in_block = in + 2*(t*nchans*npols + c*npols);
+      unsigned char *in_block = in + (t*nchans*npols + c*npols);
+      for (b=0; b<nbeams; b++) {
+        out_r[b] = 0.0;
+        out_i[b] = 0.0;
+      }
       for (p=0; p<npols; p++){
-        pr = in_block[2*p];
-        pi = in_block[2*p+1];
+        pr = nibble_to_float(in_block[p] >> 4);
+        pi = nibble_to_float(in_block[p]);
         for (b=0; b<nbeams; b++) {
           float *weight_block = weights + 2*(c*npols*nbeams + b*npols);
-          //wr = weight_block[2*p];
-          //wi = weight_block[2*p+1];
-          //out_r[b] = out_r[b] + (pr*wr - pi*wi);
-          //out_i[b] = out_i[b] + (pr*wi + pi*wr);
-          out_r[b] = out_r[b] + (pr - pi);
-          out_i[b] = out_i[b] + (pr + pi);
+          wr = weight_block[2*p];
+          wi = weight_block[2*p+1];
+          out_r[b] = out_r[b] + (pr*wr - pi*wi);
+          out_i[b] = out_i[b] + (pr*wi + pi*wr);
         }
       }
       for (b=0; b<nbeams; b++) {
@@ -95,38 +109,79 @@ void beamform_cpu(float *weights, char *in, float *out, int npols, int nchans, i
   }
 }
 
+/* Accumulate the contribution of one packed 4+4 bit sample (held in
+ * the low byte of v) to every beam
+ */
+__device__ __forceinline__
+void beamform_accumulate(unsigned int v, const float * __restrict__ weight_chan, int p,
+                         int npols, int nbeams, float *out_r, float *out_i)
+{
+  int b;
+  float pr = nibble_to_float(v >> 4);
+  float pi = nibble_to_float(v);
+  float wr, wi;
+  #pragma unroll
+  for (b=0; b<NBEAMS; b++) {
+    if (b < nbeams) {
+      wr = weight_chan[2*(b*npols + p)];
+      wi = weight_chan[2*(b*npols + p) + 1];
+      out_r[b] = out_r[b] + (pr*wr - pi*wi);
+      out_i[b] = out_i[b] + (pr*wi + pi*wr);
+    }
+  }
+}
+
+/* Beamforming kernel
+ * Launch with n_times blocks, each of n_chan threads. nbeams must
+ * be no more than NBEAMS.
+ * The packed 4+4 bit input is read directly (one byte per sample,
+ * real part in the high nibble) and unpacked in registers, so no
+ * unpacked copy of the input is ever written to memory.
+ * When npols is a multiple of 4 (so that every channel's input is
+ * word-aligned) input is loaded four samples at a time, as 32-bit
+ * words. Otherwise it is loaded a byte at a time.
+ */
 __global__
-void beamform(float *weights, char *in, float *out, int npols, int nchans, int nbeams)
+void beamform(const float * __restrict__ weights, const unsigned char * __restrict__ in,
+              float * __restrict__ out, int npols, int nchans, int nbeams)
 {
-  int ntimes = blockDim.x;
-  //int nbeams = blockDim.y;
+  int ntimes = gridDim.x;
   int t = blockIdx.x;
   int b;
   int c = threadIdx.x;
   
-  int p;
+  int p, k;
+  int nwords = (npols % 4 == 0) ? npols/4 : 0;
   float out_r[NBEAMS];
   float out_i[NBEAMS];
-  char pr, pi;
-  float wr, wi;
-  char *in_block = in + 2*(t*nchans*npols + c*npols);
-  for (p=0; p<npols; p++){
-    pr = in_block[2*p];
-    pi = in_block[2*p+1];
-    for (b=0; b<nbeams; b++) {
-      float *weight_block = weights + 2*(c*npols*nbeams + b*npols);
-      //wr = weight_block[2*p];
-      //wi = weight_block[2*p+1];
-      //out_r[b] = out_r[b] + (pr*wr - pi*wi);
-      //out_i[b] = out_i[b] + (pr*wi + pi*wr);
-      out_r[b] = out_r[b] + (pr - pi);
-      out_i[b] = out_i[b] + (pr + pi);
+  const unsigned char *in_block = in + (t*nchans*npols + c*npols);
+  const unsigned int *in_words = (const unsigned int *)in_block;
+  const float *weight_chan = weights + 2*c*npols*nbeams;
+  // Accumulators are indexed with compile-time constants (the loops
+  // over beams are fully unrolled) so that they stay in registers.
+  #pragma unroll
+  for (b=0; b<NBEAMS; b++) {
+    out_r[b] = 0.0;
+    out_i[b] = 0.0;
+  }
+  for (p=0; p<nwords; p++){
+    // Little-endian, so sample 4*p+k is byte k of the word
+    unsigned int w = in_words[p];
+    #pragma unroll
+    for (k=0; k<4; k++) {
+      beamform_accumulate(w >> (8*k), weight_chan, 4*p + k, npols, nbeams, out_r, out_i);
     }
   }
-  for (b=0; b<nbeams; b++) {
-    float *out_block = out + 2*(c*ntimes*nbeams + t*nbeams + b);
-    out_block[0] = out_r[b];
-    out_block[1] = out_i[b];
+  for (p=4*nwords; p<npols; p++){
+    beamform_accumulate(in_block[p], weight_chan, p, npols, nbeams, out_r, out_i);
+  }
+  #pragma unroll
+  for (b=0; b<NBEAMS; b++) {
+    if (b < nbeams) {
+      float *out_block = out + 2*(c*ntimes*nbeams + t*nbeams + b);
+      out_block[0] = out_r[b];
+      out_block[1] = out_i[b];
+    }
   }
 }
 
@@ -134,10 +189,10 @@ void beamform(float *weights, char *in, float *out, int npols, int nchans, int n
 #define GPUDEV 1
 int main() {
   float *weights_d;
-  float *in_d;
+  unsigned char *in_d;
   float *out_d;
   float *weights_h;
-  float *in_h;
+  unsigned char *in_h;
   float *out_h;
   struct timespec start, stop;
   long long unsigned elapsed_ns;
@@ -154,13 +209,13 @@ int main() {
 
   fprintf(stdout, "Malloc-ing\n");
   weights_h = (float *)malloc(NPOLS * NCHANS * NBEAMS * 2 * sizeof(float));
-  in_h      = (float *)malloc(NPOLS * NCHANS * NTIMES * 2 * sizeof(char));
+  in_h      = (unsigned char *)malloc(NPOLS * NCHANS * NTIMES * sizeof(char));
   out_h     = (float *)malloc(NTIMES* NCHANS * NBEAMS * 2 * sizeof(float));
   gpuErrchk( cudaMalloc(&weights_d, NPOLS * NCHANS * NBEAMS * 2 * sizeof(float)) );
-  gpuErrchk( cudaMalloc(&in_d,      NPOLS * NCHANS * NTIMES * 2 * sizeof(char)) );
+  gpuErrchk( cudaMalloc(&in_d,      NPOLS * NCHANS * NTIMES * sizeof(char)) );
   gpuErrchk( cudaMalloc(&out_d,     NTIMES* NCHANS * NBEAMS * 2 * sizeof(float)) );
   gpuErrchk( cudaMemcpy(weights_d, weights_h, NPOLS * NCHANS * NBEAMS * 2 * sizeof(float), cudaMemcpyHostToDevice) );
-  gpuErrchk( cudaMemcpy(in_d, in_h, NPOLS * NCHANS * NTIMES * 2 * sizeof(char), cudaMemcpyHostToDevice) );
+  gpuErrchk( cudaMemcpy(in_d, in_h, NPOLS * NCHANS * NTIMES * sizeof(char), cudaMemcpyHostToDevice) );
 
   dim3 blockGrid(NTIMES, NBEAMS);
   dim3 threadGrid(NCHANS);
@@ -170,9 +225,9 @@ int main() {
   clock_gettime(CLOCK_MONOTONIC, &start);
   for(n=0; n<8; n++){
     //beamform<<<blockGrid, threadGrid>>>(weights_d, (char *)in_d, out_d, NPOLS, NCHANS);
-    beamform<<<NTIMES, NCHANS>>>(weights_d, (char *)in_d, out_d, NPOLS, NCHANS, NBEAMS);
+    beamform<<<NTIMES, NCHANS>>>(weights_d, in_d, out_d, NPOLS, NCHANS, NBEAMS);
     cudaDeviceSynchronize();
-    //beamform_cpu(weights_h, (char *)in_h, out_h, NPOLS, NCHANS, NBEAMS);
+    //beamform_cpu(weights_h, in_h, out_h, NPOLS, NCHANS, NBEAMS);
   }
   clock_gettime(CLOCK_MONOTONIC, &stop);
   gpuErrchk( cudaMemcpy(out_h, out_d, NTIMES* NCHANS * NBEAMS * 2 * sizeof(float), cudaMemcpyDeviceToHost) );
@@ -14,16 +14,21 @@
 #define ELAPSED_NS(start,stop) \
   (((int64_t)stop.tv_sec-start.tv_sec)*1000*1000*1000+(stop.tv_nsec-start.tv_nsec))
 
-__constant__ unsigned int lut[16] = {0.0, 1.0, 2.0, 3.0, 4.0, 5.0, 6.0, 7.0, 248.0, 249.0, 250.0, 251.0, 252.0, 253.0, 254.0, 255.0};
+// Sign-extend a 4-bit two's complement value held in the low nibble of v
+__device__ __forceinline__ signed char nibble_to_int8(unsigned char v) {
+  return (signed char)(((v & 0xf) ^ 8) - 8);
+}
 
 // Transpose time x chan x pol x 4+4 bit to
-// chan x pol x time x 32+32 bit float
-__global__ void trans_4bit_to_float(unsigned char *in,
-                                    float *out,
-                                    int n_pol,
-                                    int n_chan,
-                                    int n_time
-                                   ) {
+// chan x pol x time x 8+8 bit integer.
+// This is the input format of the CUDA_C_8I GEMM below, and is a quarter of
+// the size of the equivalent 32+32 bit float data.
+__global__ void trans_4bit_to_ci8(unsigned char *in,
+                                  char2 *out,
+                                  int n_pol,
+                                  int n_chan,
+                                  int n_time
+                                 ) {
   //long long int tid = blockDim.y*blockDim.x*blockIdx.y + blockDim.x*blockIdx.x + threadIdx.x;
   //int pol  = tid % n_pol;
   //int chan = (tid / n_pol) % n_chan;
@@ -33,11 +38,8 @@ __global__ void trans_4bit_to_float(unsigned char *in,
   int pol = threadIdx.x;
   long long int old_index = time*n_chan*n_pol + chan*n_pol + pol;
   long long int new_index = chan*n_pol*n_time + pol*n_time + time;
-  float real, imag;
-  real = lut[in[old_index] >> 4];
-  imag = lut[in[old_index] & 0b1111];
-  out[2*new_index] = real;
-  out[2*new_index+1] = imag;
+  unsigned char v = in[old_index];
+  out[new_index] = make_char2(nibble_to_int8(v >> 4), nibble_to_int8(v));
 }
 
 // Transpose chan x beam x pol x time x 32+32 float to
@@ -165,20 +167,21 @@ void gpuBLASchk(int errval) {
 #define GPUDEV 1
 #define LOOPCNT 20
 int main() {
-  float *weights_d;
-  unsigned char  *in4_d;
-  float *in32_d;
+  char *weights_d;
+  unsigned char  *in4_d[2];
+  char2 *in8_d;
   float *out_d;
   float *pow_d;
   float *sum_out_d;
-  float *weights_h;
+  char *weights_h;
   unsigned char  *in4_h;
   float *out_h;
   struct timespec start, stop;
   long long unsigned elapsed_ns;
   long long unsigned bytes;
   double gbps;
-  float alpha = 1.0;
+  // Coefficients are 8-bit integers, scaled so that 127 represents 1.0
+  float alpha = 1.0/127;
   float beta = 0.0;
 
   bytes = NANTS*NPOLS*NCHANS*NTIMES;
@@ -190,7 +193,18 @@ int main() {
   
   cublasHandle_t handle;
   cudaStream_t stream;
+  // Input is copied to the GPU on a separate stream, into one of two
+  // buffers, so that the copy of the next gulp overlaps with processing
+  // of the current one.
+  cudaStream_t copy_stream;
+  cudaEvent_t copied[2];   // Input buffer has been filled
+  cudaEvent_t consumed[2]; // Input buffer has been read, and may be refilled
   gpuErrchk(cudaStreamCreate(&(stream)));
+  gpuErrchk(cudaStreamCreate(&(copy_stream)));
+  for (int i=0; i<2; i++) {
+    gpuErrchk(cudaEventCreateWithFlags(&(copied[i]), cudaEventDisableTiming));
+    gpuErrchk(cudaEventCreateWithFlags(&(consumed[i]), cudaEventDisableTiming));
+  }
   gpuBLASchk(cublasCreate(&(handle)));
   gpuBLASchk(cublasSetStream(handle, stream));
   gpuBLASchk(cublasSetPointerMode(handle, CUBLAS_POINTER_MODE_HOST));
@@ -213,17 +227,18 @@ int main() {
   fprintf(stdout, "bytes processed (4-bit input): %llu\n", bytes);
 
   fprintf(stdout, "Malloc-ing\n");
-  weights_h = (float *)malloc(NANTS * NPOLS * NCHANS * NBEAMS * 2 * sizeof(float));
-  in4_h      = (unsigned char *)malloc(NANTS * NPOLS * NCHANS * NTIMES * sizeof(char));
+  weights_h = (char *)malloc(NANTS * NPOLS * NCHANS * NBEAMS * 2 * sizeof(char));
+  // Pinned, so that host to device copies can be asynchronous
+  gpuErrchk( cudaMallocHost(&in4_h, NANTS * NPOLS * NCHANS * NTIMES * sizeof(char)) );
   out_h     = (float *)malloc(NTIMES* NCHANS * NBEAMS * 2 * sizeof(float));
-  gpuErrchk( cudaMalloc(&weights_d, NANTS * NPOLS * NCHANS * NBEAMS * 2 * sizeof(float)) );
-  gpuErrchk( cudaMalloc(&in4_d,      NANTS * NPOLS * NCHANS * NTIMES * sizeof(char)) );
-  gpuErrchk( cudaMalloc(&in32_d,      NANTS * NPOLS * NCHANS * NTIMES * 2 * sizeof(float)) );
+  gpuErrchk( cudaMalloc(&weights_d, NANTS * NPOLS * NCHANS * NBEAMS * 2 * sizeof(char)) );
+  gpuErrchk( cudaMalloc(&in4_d[0],   NANTS * NPOLS * NCHANS * NTIMES * sizeof(char)) );
+  gpuErrchk( cudaMalloc(&in4_d[1],   NANTS * NPOLS * NCHANS * NTIMES * sizeof(char)) );
+  gpuErrchk( cudaMalloc(&in8_d,      NANTS * NPOLS * NCHANS * NTIMES * sizeof(char2)) );
   gpuErrchk( cudaMalloc(&out_d,     NTIMES* NCHANS * NBEAMS * 2 * sizeof(float)) );
   //gpuErrchk( cudaMalloc(&pow_d,     NTIMES* NCHANS * NBEAMS * sizeof(float)) );
   gpuErrchk( cudaMalloc(&sum_out_d,     NTIMEBLOCKS * NCHANS * NBEAMS/2 * 4 * sizeof(float)) );
-  gpuErrchk( cudaMemcpy(weights_d, weights_h, NANTS * NPOLS * NCHANS * NBEAMS * 2 * sizeof(float), cudaMemcpyHostToDevice) );
-  gpuErrchk( cudaMemcpy(in4_d, in4_h, NANTS * NPOLS * NCHANS * NTIMES * sizeof(char), cudaMemcpyHostToDevice) );
+  gpuErrchk( cudaMemcpy(weights_d, weights_h, NANTS * NPOLS * NCHANS * NBEAMS * 2 * sizeof(char), cudaMemcpyHostToDevice) );
 
   dim3 transBlockGrid(NTIMES, NCHANS);
   dim3 transThreadGrid(NPOLS);
@@ -233,11 +248,27 @@ int main() {
   int n;
   fprintf(stdout, "Calling kernel\n");
   clock_gettime(CLOCK_MONOTONIC, &start);
+  // Copy the first gulp
+  gpuErrchk( cudaMemcpyAsync(in4_d[0], in4_h, NANTS * NPOLS * NCHANS * NTIMES * sizeof(char), cudaMemcpyHostToDevice, copy_stream) );
+  gpuErrchk( cudaEventRecord(copied[0], copy_stream) );
   for(n=0; n<LOOPCNT; n++){
-    // Transpose input data and promote to float.
-    // CUBLAS doesn't support float coeffs with int8 data
-    trans_4bit_to_float<<<transBlockGrid, transThreadGrid, 0, stream>>>(in4_d, in32_d, NPOLS, NCHANS, NTIMES);
-    cudaStreamSynchronize(stream);
+    int cur = n & 1;
+    int nxt = (n+1) & 1;
+    // Start copying the next gulp, once the buffer it goes in is no longer
+    // being read (waiting on a not-yet-recorded event returns immediately)
+    if (n+1 < LOOPCNT) {
+      gpuErrchk( cudaStreamWaitEvent(copy_stream, consumed[nxt], 0) );
+      gpuErrchk( cudaMemcpyAsync(in4_d[nxt], in4_h, NANTS * NPOLS * NCHANS * NTIMES * sizeof(char), cudaMemcpyHostToDevice, copy_stream) );
+      gpuErrchk( cudaEventRecord(copied[nxt], copy_stream) );
+    }
+    // Transpose input data and promote to 8-bit.
+    // CUBLAS doesn't support float coeffs with int8 data, so the coefficients
+    // are also 8-bit, and are normalized through alpha.
+    gpuErrchk( cudaStreamWaitEvent(stream, copied[cur], 0) );
+    trans_4bit_to_ci8<<<transBlockGrid, transThreadGrid, 0, stream>>>(in4_d[cur], in8_d, NPOLS, NCHANS, NTIMES);
+    gpuErrchk( cudaEventRecord(consumed[cur], stream) );
+    // The remaining steps are all issued on `stream`, so are ordered
+    // without any host synchronization
 
     // GEMM:
     // C <= alpha*AB + beta*C
@@ -254,14 +285,12 @@ int main() {
       // Coeffs
       &alpha,      // alpha
       weights_d,   // A
-      CUDA_C_32F,  // A type
-      //CUDA_C_8I,  // A type
+      CUDA_C_8I,   // A type
       NBEAMS,      // Lda
       NBEAMS*NANTS,// strideA : stride size
       // Data
-      in32_d,        // B
-      CUDA_C_32F,   // B type
-      //CUDA_C_8I,   // B type
+      in8_d,       // B
+      CUDA_C_8I,   // B type
       NANTS,       // Ldb
       NANTS*NTIMES,// strideB : stride size
       &beta,       // beta
@@ -274,11 +303,9 @@ int main() {
       CUDA_C_32F,  // compute type
       CUBLAS_GEMM_DEFAULT_TENSOR_OP // algo
       ));
-    cudaStreamSynchronize(stream);
     trans_output_and_sum<<<sumBlockGrid, sumThreadGrid, 0, stream>>>(out_d, sum_out_d, NCHANS, NBEAMS/2, NTIMES, NTIMES_SUM);
-    cudaStreamSynchronize(stream);
-
   }
+  gpuErrchk( cudaStreamSynchronize(stream) );
   clock_gettime(CLOCK_MONOTONIC, &stop);
   //gpuErrchk( cudaMemcpy(out_h, out_d, NTIMES* NCHANS * NBEAMS * 2 * sizeof(float), cudaMemcpyDeviceToHost) );
 
@@ -290,11 +317,18 @@ int main() {
   fprintf(stdout, "Bandwidth: %.2f MHz\n", 1000*gbps / 8 / NPOLS / NANTS);
   
   cudaFree(weights_d);
-  cudaFree(in4_d);
-  cudaFree(in32_d);
+  cudaFree(in4_d[0]);
+  cudaFree(in4_d[1]);
+  cudaFree(in8_d);
   cudaFree(out_d);
   free(weights_h);
-  free(in4_h);
+  cudaFreeHost(in4_h);
+  for (int i=0; i<2; i++) {
+    cudaEventDestroy(copied[i]);
+    cudaEventDestroy(consumed[i]);
+  }
+  cudaStreamDestroy(copy_stream);
+  cudaStreamDestroy(stream);
   free(out_h);
 
   return 0;
@@ -13,7 +13,9 @@ import time
 import ujson as json
 import numpy as np
 
-from .block_base import Block, COMMAND_OK, COMMAND_INVALID
+from .block_base import Block, COMMAND_OK, COMMAND_INVALID, unpack_ndarrays, decode_commands
+
+STATS_UPDATE_PERIOD = 1.0 # Seconds between writes of the stats proclog
 
 class Beamform(Block):
     # Note: Input data are: [time,chan,ant,pol,cpx,8bit]
@@ -182,8 +184,8 @@ class Beamform(Block):
         | ``beam_id``      | int             |        | Beam index which these beamforming coefficients |
         |                  |                 |        | should be applied.                              |
         +------------------+-----------------+--------+-------------------------------------------------+
-        | ``data``         |                 |        | If ``type==calgains`` a list of floats of       |
-        |                  |                 |        | length ``2*nchan``. Entry ``2i`` of this list   |
+        | ``data``         |                 |        | If ``type==calgains`` an array of floats of     |
+        |                  |                 |        | length ``2*nchan``. Entry ``2i`` of this array  |
         |                  |                 |        | is the real part of the calibration gain for    |
         |                  |                 |        | frequency channel ``i``. Entry ``2i+1`` is the  |
         |                  |                 |        | imaginary part of the calibration gain for      |
@@ -227,19 +229,35 @@ class Beamform(Block):
         if self.gpu != -1:
             BFSetGPU(self.gpu)
         ## Delays and gains
-        self.cal_gains = np.ones((nchan, nbeam, ninput), dtype=np.complex64) #: calibration gains
-        # Three buffers for complex gains.
-        #   `gains_cpu_new` is the latest set of coefficients. As soon as new coefficients arrive
+        # The complex gains are computed on the GPU, from per-beam delays and amplitudes,
+        # and per-channel calibration gains. Each of these has two CPU-side buffers:
+        #   `*_new` is the latest set of values. As soon as new coefficients arrive
         #   they are loaded here.
-        #   `gains_cpu is` the set of coefficient array waiting to be copied to the GPU. coefficients
-        #   from gains_cpu_new are copied to gains_cpu when a user-supplied trigger time is reached
-        #   `gains_gpu` is the coefficient set in GPU device memory. Whenever gains_cpu_new changes,
-        #   these coefficients are copied. Copies go through an intermediate CPU buffer so that all
-        #   transfers to GPU memory are contiguous.
-        self.gains_cpu_new = np.zeros((nchan, nbeam, ninput), dtype=np.complex64) #: CPU-side beamformer coeffs waiting to be activated
-        self.gains_cpu = np.zeros((nchan, nbeam, ninput), dtype=np.complex64) #: CPU-side beamformer coeffs to be copied
+        #   `*_cpu` is the set of values waiting to be copied to the GPU. Values
+        #   from `*_new` are copied here when a user-supplied trigger time is reached.
+        # Only the (small) delay and amplitude vectors are copied to the GPU on every
+        # coefficient load. The (large) calibration array is only copied when it
+        # has changed.
+        self.cal_gains = np.ones((nchan, nbeam, ninput), dtype=np.complex64) #: calibration gains, as most recently received
+        self.cal_gains_new = np.ones((nchan, nbeam, ninput), dtype=np.complex64) #: calibration gains captured with the latest beam coeffs
+        self.cal_gains_cpu = np.ones((nchan, nbeam, ninput), dtype=np.complex64) #: calibration gains to be copied
+        self.cal_gains_gpu = BFArray(shape=(nchan, nbeam, ninput), dtype=np.complex64, space='cuda') #: GPU-side calibration gains
+        self.delays_cpu_new = np.zeros((nbeam, ninput), dtype=np.float32) #: beam delays (ns) waiting to be activated
+        self.delays_cpu = np.zeros((nbeam, ninput), dtype=np.float32) #: beam delays (ns) to be copied
+        self.delays_gpu = BFArray(shape=(nbeam, ninput), dtype=np.float32, space='cuda') #: GPU-side beam delays (ns)
+        self.amps_cpu_new = np.zeros((nbeam, ninput), dtype=np.float32) #: beam amplitudes waiting to be activated
+        self.amps_cpu = np.zeros((nbeam, ninput), dtype=np.float32) #: beam amplitudes to be copied
+        self.amps_gpu = BFArray(shape=(nbeam, ninput), dtype=np.float32, space='cuda') #: GPU-side beam amplitudes
+        self.freqs_gpu = BFArray(shape=(nchan,), dtype=np.float64, space='cuda') #: GPU-side channel center frequencies (Hz)
         self.gains_gpu = BFArray(shape=(nchan, nbeam, ninput), dtype=np.complex64, space='cuda') #: GPU-side beamformer coeffs
-        self.gains_load_sample = np.zeros(nbeam) #: sample time at which gains_cpu_new should be copied to gains_cpu (and on to gains_gpu)
+        self.gains_load_sample = np.zeros(nbeam) #: sample time at which *_new values should be copied to *_cpu (and on to the GPU)
+        self._next_load_sample = -1 # Earliest pending value in gains_load_sample
+        self._cal_stale = np.zeros(nbeam, dtype=bool) # cal_gains has changed since cal_gains_new was captured
+        self._cal_load = np.zeros(nbeam, dtype=bool) # cal_gains_new should be copied to cal_gains_cpu on load
+        self._cal_upload = True # cal_gains_cpu should be copied to the GPU
+
+        self.freqs = None #: Channel center frequencies (Hz) of the current sequence
+        self._freq_key = None
 
         self.define_command_key('coeffs', type=dict, initial_val={})
 
@@ -250,6 +268,21 @@ class Beamform(Block):
         else:
             _bf.bfBeamformInitialize(self.gpu, self.ninput, self.nchan, self.ntime_gulp, self.nbeam, 0)
 
+    def _compute_gains(self):
+        """
+        Regenerate the GPU-side complex gains from the GPU-side
+        frequencies, delays, amplitudes and calibration gains.
+        """
+        BFMap("""
+              double p = 6.283185307179586e-9 * freqs(c) * delays(b,i);
+              gains(c,b,i) = cal(c,b,i) * Complex<float>(amps(b,i)*cos(p), amps(b,i)*sin(p));
+              """,
+              shape=self.gains_gpu.shape,
+              axis_names=('c', 'b', 'i'),
+              data={'gains': self.gains_gpu, 'cal': self.cal_gains_gpu,
+                    'freqs': self.freqs_gpu, 'delays': self.delays_gpu,
+                    'amps': self.amps_gpu})
+
     #def _compute_weights(self, sfreq, nchan, chan_bw):
     #    """
     #    Regenerate complex gains from
@@ -268,7 +301,7 @@ class Beamform(Block):
         """
         A callback executed whenever this block's command key is modified.
 
-        This callback JSON decodes the key contents, and passes the
+        This callback decodes the key contents, and passes the
         resulting dictionary to ``_process_commands``.
         The ``last_cmd_response`` status value is set to the return value of
         ``_process_commands`` to indicate any error conditions
@@ -284,30 +317,34 @@ class Beamform(Block):
         cpu_affinity.set_core(self.core)
         self.acquire_control_lock()
         for event in watchresponse.events:
-            v = json.loads(event.value)
-            seq_id = v.get('id', None)
-            if seq_id is None:
-                self._send_command_response("0", False, "Missing ID field")
-                continue
-            cmd = v.get('cmd', None)
-            if cmd != "update":
-                self._send_command_response("0", False, "Invalid command")
-                continue
-            val = v.get("val", None)
-            if not isinstance(val, dict):
-                self._send_command_response(seq_id, False, "`val` field should be a dictionary")
-                continue
-            update_keys = val.get("kwargs", None)
-            if not isinstance(update_keys, dict):
-                self._send_command_response(seq_id, False, "`val[kwargs]` field should be a dictionary")
-                continue
-            try:
-                proc_ok = self._process_commands(update_keys, set_pending_flag=False)
-            except:
-                proc_ok = COMMAND_INVALID
-            self.update_stats({'last_cmd_response':proc_ok})
-            self.update_command_vals()
-            self._send_command_response(seq_id, proc_ok==COMMAND_OK, str(proc_ok))
+            cmds = decode_commands(event.value)
+            # Batched commands to this block arrive as a list of commands
+            if not isinstance(cmds, list):
+                cmds = [cmds]
+            for v in cmds:
+                seq_id = v.get('id', None)
+                if seq_id is None:
+                    self._send_command_response("0", False, "Missing ID field")
+                    continue
+                cmd = v.get('cmd', None)
+                if cmd != "update":
+                    self._send_command_response("0", False, "Invalid command")
+                    continue
+                val = v.get("val", None)
+                if not isinstance(val, dict):
+                    self._send_command_response(seq_id, False, "`val` field should be a dictionary")
+                    continue
+                update_keys = val.get("kwargs", None)
+                if not isinstance(update_keys, dict):
+                    self._send_command_response(seq_id, False, "`val[kwargs]` field should be a dictionary")
+                    continue
+                try:
+                    proc_ok = self._process_commands(unpack_ndarrays(update_keys), set_pending_flag=False)
+                except:
+                    proc_ok = COMMAND_INVALID
+                self.update_stats({'last_cmd_response':proc_ok})
+                self.update_command_vals()
+                self._send_command_response(seq_id, proc_ok==COMMAND_OK, str(proc_ok))
         self.release_control_lock()
 
     def update_command_vals(self):
@@ -328,16 +365,24 @@ class Beamform(Block):
                    i = v['input_id']
                    b = v['beam_id']
                    self.log.debug("BEAMFORM >> Updating calibration gains for beam %d, input %d" % (b,i))
-                   data = np.array(v['data'])
-                   self.cal_gains[:, b, i] = data[0::2] + 1j*data[1::2] # freq x beam x input
+                   # Interleaved real/imag float32 data is the memory layout of complex64
+                   data = np.ascontiguousarray(v['data'], dtype=np.float32).view(np.complex64)
+                   self.cal_gains[:, b, i] = data # freq x beam x input
+                   self._cal_stale[b] = True
                if v['type'] == 'beamcoeffs':
                    b = v['beam_id']
                    self.log.debug("BEAMFORM >> Updating delays for beam %d" % (b))
-                   delays_ns = np.array(v['data']['delays'])
-                   amps = np.array(v['data']['amps'])
-                   phases = np.exp(1j*2*np.pi*self.freqs[:, None]*delays_ns*1e-9) # freq x input
-                   self.gains_cpu_new[:, b, :] = amps * phases * self.cal_gains[:, b, :] # freq x beam x input
+                   self.delays_cpu_new[b] = v['data']['delays']
+                   self.amps_cpu_new[b] = v['data']['amps']
+                   if self._cal_stale[b]:
+                       self.cal_gains_new[:, b, :] = self.cal_gains[:, b, :] # freq x beam x input
+                       self._cal_stale[b] = False
+                       self._cal_load[b] = True
                    self.gains_load_sample[b] = v.get('load_sample', -1) # default to immediate load
+                   if self.update_pending:
+                       self._next_load_sample = min(self._next_load_sample, self.gains_load_sample[b])
+                   else:
+                       self._next_load_sample = self.gains_load_sample[b]
                    # Only trigger update on beamcoeffs, not calibration only.
                    # This means loading [lots of] calibration data has less of an impact on the
                    # pipeline performance. Calibrations are only loaded after beamformer weights are applied.
@@ -360,10 +405,15 @@ class Beamform(Block):
         oshape = (self.ntime_gulp,self.nchan,self.nbeam*2)
         self.oring.resize(ogulp_size)
 
+        # gains_gpu is only ever updated in place, so its array descriptor
+        # can be built once rather than on every gulp
+        gains_gpu_bf = self.gains_gpu.as_BFarray()
+
         with self.oring.begin_writing() as oring:
             for iseq in self.iring.read(guarantee=self.guarantee):
                 # recalculate beamforming coefficients on each new sequence (freqs could have changed)
                 self.update_pending = True
+                self._next_load_sample = -1 # Check for due loads on the first gulp
                 copy_pending = True
                 ihdr = json.loads(iseq.header.tostring())
                 
@@ -379,9 +429,10 @@ class Beamform(Block):
 
                 assert nchan == self.nchan
                 assert self.ninput == nstand * npol
-                self.freqs = np.arange(sfreq, sfreq+nchan*chan_bw, chan_bw)
-                
-                freqs = np.arange(sfreq, sfreq+nchan*chan_bw, chan_bw)
+                if self._freq_key != (sfreq, nchan, chan_bw):
+                    self._freq_key = (sfreq, nchan, chan_bw)
+                    self.freqs = np.arange(sfreq, sfreq+nchan*chan_bw, chan_bw)
+                    self.freqs_gpu[...] = self.freqs
 
                 
                 ohdr = ihdr.copy()
@@ -393,29 +444,44 @@ class Beamform(Block):
                 ohdr_str = json.dumps(ohdr)
                 
                 prev_time = time.time()
+                last_stats_time = 0
                 with oring.begin_sequence(time_tag=iseq.time_tag, header=ohdr_str) as oseq:
                     for ispan in iseq.read(igulp_size):
-                        self.update_stats({'curr_sample': this_gulp_time})
+                        self.stats['curr_sample'] = this_gulp_time
                         if ispan.size < igulp_size:
                             continue # Ignore final gulp
-                        if self.update_pending:
+                        # Only take the control lock when a coefficient load is due
+                        if self.update_pending and this_gulp_time >= self._next_load_sample:
                             self.acquire_control_lock()
                             for b in range(self.nbeam):
                                 if self.gains_load_sample[b] == 0:
                                     continue
                                 if this_gulp_time >= self.gains_load_sample[b]:
-                                    self.gains_cpu[:,b,:] = self.gains_cpu_new[:,b,:]
+                                    self.delays_cpu[b] = self.delays_cpu_new[b]
+                                    self.amps_cpu[b] = self.amps_cpu_new[b]
+                                    if self._cal_load[b]:
+                                        self.cal_gains_cpu[:,b,:] = self.cal_gains_new[:,b,:]
+                                        self._cal_load[b] = False
+                                        self._cal_upload = True
                                     self.gains_load_sample[b] = 0
                                     copy_pending = True
-                            if self.gains_load_sample.sum() == 0:
+                            pending_loads = self.gains_load_sample[self.gains_load_sample != 0]
+                            if pending_loads.size == 0:
                                 self.update_pending = False
+                            else:
+                                self._next_load_sample = pending_loads.min()
                             self.stats['update_pending'] = self.update_pending
                             self.stats['last_cmd_proc_time'] = time.time()
                             self.release_control_lock()
                         
                         if copy_pending:
                             self.log.debug("BEAMFORM >> Copy coefficients to GPU at time %d" % this_gulp_time)
-                            self.gains_gpu[...] = self.gains_cpu
+                            if self._cal_upload:
+                                self.cal_gains_gpu[...] = self.cal_gains_cpu
+                                self._cal_upload = False
+                            self.delays_gpu[...] = self.delays_cpu
+                            self.amps_gpu[...] = self.amps_cpu
+                            self._compute_gains()
                             copy_pending = False
 
                         curr_time = time.time()
@@ -431,7 +497,7 @@ class Beamform(Block):
                             idata = ispan.data_view('i8')
                             odata = ospan.data_view(np.float32)
                             
-                            _bf.bfBeamformRun(idata.as_BFarray(), odata.as_BFarray(), self.gains_gpu.as_BFarray())
+                            _bf.bfBeamformRun(idata.as_BFarray(), odata.as_BFarray(), gains_gpu_bf)
                             BFSync()
                             
                         ## Update the base time tag
@@ -444,3 +510,7 @@ class Beamform(Block):
                                                   'reserve_time': reserve_time, 
                                                   'process_time': process_time,
                                                   'gbps': 8*igulp_size / process_time / 1e9})
+                        # Publish curr_sample periodically, rather than every gulp
+                        if curr_time - last_stats_time >= STATS_UPDATE_PERIOD:
+                            self.update_stats()
+                            last_stats_time = curr_time
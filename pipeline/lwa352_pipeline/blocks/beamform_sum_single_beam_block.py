@@ -36,6 +36,7 @@ class BeamformSumSingleBeam(Block):
         self.ntime_sum = ntime_sum
         assert ntime_gulp % ntime_sum == 0
         self.ntime_blocks = ntime_gulp // ntime_sum
+        self._ticks_per_gulp = self.ntime_gulp * (int(FS) // int(CHAN_BW)) # Time tag increment per gulp
         
         self.nchan_max = nchan_max
 
@@ -73,7 +74,6 @@ class BeamformSumSingleBeam(Block):
                 nstand = ihdr['nstand']
                 npol   = ihdr['npol']
                 
-                ticksPerTime = int(FS) / int(CHAN_BW)
                 base_time_tag = iseq.time_tag
                 
                 ohdr = ihdr.copy()
@@ -116,7 +116,7 @@ class BeamformSumSingleBeam(Block):
                             BFSync()
                             
                         ## Update the base time tag
-                        base_time_tag += self.ntime_gulp*ticksPerTime
+                        base_time_tag += self._ticks_per_gulp
                         
                         curr_time = time.time()
                         process_time = curr_time - prev_time
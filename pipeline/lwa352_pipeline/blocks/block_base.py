@@ -9,8 +9,12 @@ from bifrost.ndarray import copy_array
 from bifrost.device import stream_synchronize, set_device as BFSetGPU
 
 import time
+import base64
 import ujson as json
 import socket
+import numpy as np
+import blosc
+import msgpack
 
 from threading import Lock
 
@@ -19,6 +23,73 @@ COMMAND_NOT_RECOGNIZED = -1
 COMMAND_WRONG_TYPE = -2
 COMMAND_INVALID = -3
 
+#: Leading byte marking a command as MessagePack, rather than JSON, encoded.
+MSGPACK_PREFIX = b'\x01'
+
+def decode_commands(value):
+    """
+    Decode the contents of a command key. Commands are JSON-encoded unless
+    they start with ``MSGPACK_PREFIX``, in which case the remainder is
+    MessagePack-encoded.
+
+    :param value: The raw value of the command key
+    :type value: bytes or str
+
+    :return: The decoded command, or list of commands
+    """
+    if isinstance(value, bytes) and value[:1] == MSGPACK_PREFIX:
+        return msgpack.unpackb(value[1:], raw=False)
+    return json.loads(value)
+
+def unpack_ndarrays(d):
+    """
+    Replace any binary-encoded numpy arrays in a decoded command
+    dictionary with the arrays they represent.
+
+    Arrays are sent by the control library as dictionaries with keys
+    ``__nd__``, ``dtype``, ``shape`` and ``data``, where ``data`` is
+    blosc-compressed little-endian array data. In JSON-encoded commands
+    ``data`` is base64 encoded; in MessagePack-encoded commands it is raw
+    bytes. Only dictionary values are searched (recursively); lists are
+    left untouched.
+
+    :param d: Decoded command dictionary
+    :type d: dict
+
+    :return: Dictionary with encoded arrays replaced by ``numpy.ndarray`` objects
+    :rtype: dict
+    """
+    if d.get('__nd__', False):
+        data = d['data']
+        if not isinstance(data, bytes):
+            data = base64.b64decode(data)
+        buf = blosc.decompress(data, as_bytearray=True)
+        return np.frombuffer(buf, dtype=np.dtype(d['dtype'])).reshape(d['shape'])
+    for k, v in d.items():
+        if isinstance(v, dict):
+            d[k] = unpack_ndarrays(v)
+    return d
+
+def stats_value(v):
+    """
+    Convert a value to a form which can be written to a stats proclog.
+    The proclog is parsed line by line, so numpy arrays, whose string
+    representations span multiple lines, are converted to lists. Arrays
+    nested in dictionaries and lists (e.g. in decoded commands) are also
+    converted.
+
+    :param v: Value to be logged
+
+    :return: ``v``, with any numpy arrays replaced by lists
+    """
+    if isinstance(v, np.ndarray):
+        return v.tolist()
+    elif isinstance(v, dict):
+        return {k: stats_value(x) for k, x in v.items()}
+    elif isinstance(v, (list, tuple)):
+        return [stats_value(x) for x in v]
+    return v
+
 class Block(object):
     """
     The base class for a bifrost LWA352 processing block
@@ -180,7 +251,8 @@ class Block(object):
         :type initial_val: ``type``
         """
         
-        if initial_val:
+        # numpy arrays have no truth value, so check those by size
+        if (initial_val.size if isinstance(initial_val, np.ndarray) else initial_val):
             if type:
                 assert isinstance(initial_val, type), "%s: key %s: Initial value type check fail!" % (self.name, name)
             if condition:
@@ -216,7 +288,7 @@ class Block(object):
         """
         A callback executed whenever this block's command key is modified.
 
-        This callback JSON decodes the key contents, and passes the
+        This callback decodes the key contents, and passes the
         resulting dictionary to ``_process_commands``.
         The ``last_cmd_response`` status value is set to the return value of
         ``_process_commands`` to indicate any error conditions
@@ -228,29 +300,33 @@ class Block(object):
         cpu_affinity.set_core(self.core)
         self._control_lock.acquire()
         for event in watchresponse.events:
-            v = json.loads(event.value)
-            seq_id = v.get('id', None)
-            if seq_id is None:
-                self._send_command_response("0", False, "Missing ID field")
-                continue
-            cmd = v.get('cmd', None)
-            if cmd != "update":
-                self._send_command_response("0", False, "Invalid command")
-                continue
-            val = v.get("val", None)
-            if not isinstance(val, dict):
-                self._send_command_response(seq_id, False, "`val` field should be a dictionary")
-                continue
-            update_keys = val.get("kwargs", None)
-            if not isinstance(update_keys, dict):
-                self._send_command_response(seq_id, False, "`val[kwargs]` field should be a dictionary")
-                continue
-            try:
-                proc_ok = self._process_commands(update_keys)
-            except:
-                proc_ok = COMMAND_INVALID
-            self.update_stats({'last_cmd_response':proc_ok})
-            self._send_command_response(seq_id, proc_ok==COMMAND_OK, str(proc_ok))
+            cmds = decode_commands(event.value)
+            # Batched commands to this block arrive as a list of commands
+            if not isinstance(cmds, list):
+                cmds = [cmds]
+            for v in cmds:
+                seq_id = v.get('id', None)
+                if seq_id is None:
+                    self._send_command_response("0", False, "Missing ID field")
+                    continue
+                cmd = v.get('cmd', None)
+                if cmd != "update":
+                    self._send_command_response("0", False, "Invalid command")
+                    continue
+                val = v.get("val", None)
+                if not isinstance(val, dict):
+                    self._send_command_response(seq_id, False, "`val` field should be a dictionary")
+                    continue
+                update_keys = val.get("kwargs", None)
+                if not isinstance(update_keys, dict):
+                    self._send_command_response(seq_id, False, "`val[kwargs]` field should be a dictionary")
+                    continue
+                try:
+                    proc_ok = self._process_commands(unpack_ndarrays(update_keys))
+                except:
+                    proc_ok = COMMAND_INVALID
+                self.update_stats({'last_cmd_response':proc_ok})
+                self._send_command_response(seq_id, proc_ok==COMMAND_OK, str(proc_ok))
         self._control_lock.release()
 
     def _send_command_response(self, seq_id, processed_ok, response):
@@ -338,7 +414,7 @@ class Block(object):
                     return COMMAND_INVALID
             self._pending_command_vals[key] = command_dict[key]
             # Track the command status in the stats log
-            self.stats['new_' + key] = command_dict[key]
+            self.stats['new_' + key] = stats_value(command_dict[key])
         if set_pending_flag:
             self.update_pending = True
         self.stats['update_pending'] = True
@@ -381,7 +457,8 @@ class Block(object):
         :type new_stats: dict
         """
         # This function updates without deleting everything
-        self.stats.update(new_stats)
+        for k, v in new_stats.items():
+            self.stats[k] = stats_value(v)
         # This function deletes everything and replaces
         self.stats_proclog.update(self.stats)
 
@@ -191,17 +191,26 @@ class Capture(object):
         if input_to_ant is not None:
             self.input_to_ant = input_to_ant
         else:
-            self.input_to_ant = np.zeros([nstand*npol, 2], dtype=np.int32)
-            for s in range(nstand):
-                for p in range(npol):
-                    self.input_to_ant[npol*s + p] = [s, p]
+            idx = np.arange(nstand*npol, dtype=np.int32)
+            self.input_to_ant = np.stack([idx // npol, idx % npol], axis=1)
 
+        inputs = np.asarray(self.input_to_ant)
         self.ant_to_input = np.zeros([nstand, npol], dtype=np.int32)
-        for i, inp in enumerate(self.input_to_ant):
-            stand = inp[0]
-            pol = inp[1]
-            self.ant_to_input[stand, pol] = i
+        self.ant_to_input[inputs[:,0], inputs[:,1]] = np.arange(inputs.shape[0])
         self.time_tag = 0
+        self.header_buf = None # Reused between sequences. See seq_callback
+        # Pre-encode the sequence header fields which never change, as
+        # '{"key":val,...' without the closing brace, so that seq_callback
+        # only has to encode the few fields which do.
+        hdr_static = {'system_nchan': self.system_nchan,
+                      'fs_hz':    self.fs_hz,
+                      'nstand':   self.nstand,
+                      #'input_to_ant': self.input_to_ant.tolist(),
+                      #'ant_to_input': self.ant_to_input.tolist(),
+                      'npol':     self.npol,
+                      'complex':  True,
+                      'nbit':     4}
+        self._hdr_static_str = json.dumps(hdr_static).encode()[:-1]
            
         ## HACK TESTING
         #self.seq_callback = None
@@ -258,27 +267,28 @@ starts a new sequence.
                'seq0':     seq0, 
                'chan0':    chan0,
                'nchan':    nchan,
-               'system_nchan':    self.system_nchan,
-               'fs_hz':    self.fs_hz,
-               'sfreq':    chan0*self.chan_bw_hz,
-               'bw_hz':    nchan*self.chan_bw_hz,
-               'nstand':   self.nstand,
-               #'input_to_ant': self.input_to_ant.tolist(),
-               #'ant_to_input': self.ant_to_input.tolist(),
                #'stand0':   src0*16, # TODO: Pass src0 to the callback too(?)
-               'npol':     self.npol,
-               'complex':  True,
-               'nbit':     4}
+               'sfreq':    chan0*self.chan_bw_hz,
+               'bw_hz':    nchan*self.chan_bw_hz}
         #if self.input_to_ant.shape != (nstand, npol):
         #    self.log.error("Input order shape %s does not match data stream (%d, %d)" %
         #                    (self.input_to_ant.shape, nstand, npol))
 
-        hdr_str = json.dumps(hdr).encode()
+        # Splice the dynamic fields into the pre-encoded static ones
+        hdr_str = self._hdr_static_str + b',' + json.dumps(hdr).encode()[1:]
         #hdr_str = b'\x00\x00\x00\x00'
         # TODO: Can't pad with NULL because returned as C-string
         #hdr_str = json.dumps(hdr).ljust(4096, '\0')
         #hdr_str = json.dumps(hdr).ljust(4096, ' ')
-        self.header_buf = ctypes.create_string_buffer(hdr_str)
+        # Reuse the existing header buffer if it is big enough (leaving space
+        # for the NULL terminator), rather than allocating one per sequence.
+        # The buffer is allocated with some headroom, since the header length
+        # changes a little as timestamps grow.
+        if self.header_buf is None or len(hdr_str) >= len(self.header_buf):
+            self.header_buf = ctypes.create_string_buffer(hdr_str, 2*len(hdr_str))
+        else:
+            ctypes.memmove(self.header_buf, hdr_str, len(hdr_str))
+            self.header_buf[len(hdr_str)] = b'\0'
         hdr_ptr[0]      = ctypes.cast(self.header_buf, ctypes.c_void_p)
         hdr_size_ptr[0] = len(hdr_str)
         #t1 = time.time()
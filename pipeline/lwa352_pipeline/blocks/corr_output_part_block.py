@@ -80,6 +80,9 @@ class CorrOutputPart(Block):
         |               |        |       | ``N_0``, polarization ``P_0`` with stand       |
         |               |        |       | ``N_1``, polarization ``P_1``                  |
         +---------------+--------+-------+------------------------------------------------+
+        | ``nbit``      | int    | -     | Optional. Number of bits per real/imag input   |
+        |               |        |       | component; 16 or 32. Defaults to 32.           |
+        +---------------+--------+-------+------------------------------------------------+
 
     **Output Headers**
 
@@ -87,9 +90,12 @@ class CorrOutputPart(Block):
 
     **Data Buffers**
 
-    *Input Data Buffer*: A CPU-side bifrost ring buffer with 32+32 bit complex integer data
+    *Input Data Buffer*: A CPU-side bifrost ring buffer with 32+32 bit (or, if the
+    input header has ``nbit=16``, 16+16 bit) complex integer data
     in order ``time x channel x visibility x complexity``
-    This input buffer is read in gulps of ``nchan x nvis`` words, each 8 bytes in size.
+    This input buffer is read in gulps of ``nchan x nvis`` words, each 8 (or 4) bytes in size.
+    16-bit data are widened to 32 bits before packetization, so the output
+    packet format does not depend on ``nbit``.
 
     *Output Data Buffer*: This block has no output data buffer.
 
@@ -421,12 +427,15 @@ class CorrOutputPart(Block):
             chan0 = ihdr['chan0']
             bw_hz = ihdr['bw_hz']
             nvis  = ihdr['nvis']
+            # Upstream data may be 16+16 bit, but are always sent as 32+32 bit
+            nbit  = ihdr.get('nbit', 32)
+            idtype = 'i%d' % nbit
             if not self.use_cor_fmt:
                 sfreq = ihdr['sfreq']
             if self.use_cor_fmt:
                 samples_per_spectra = int(nchan_sum * nchan * ihdr['fs_hz'] / bw_hz)
-            igulp_size = nvis * nchan * 8
-            dout = np.zeros(shape=[nvis, nchan, 2], dtype='>i')
+            igulp_size = nvis * nchan * 2 * nbit // 8
+            dout = np.empty(shape=[nvis, nchan, 2], dtype='>i')
             for ispan in iseq.read(igulp_size):
                 if ispan.size < igulp_size:
                     continue # skip last gulp
@@ -452,13 +461,15 @@ class CorrOutputPart(Block):
                     if self.use_cor_fmt:
                         time_tag = this_gulp_time * samples_per_spectra
                         # Read chan x baseline x complexity input data.
-                        idata = ispan.data_view('i32').reshape([nchan, nvis, 2])
+                        idata = ispan.data_view(idtype).reshape([nchan, nvis, 2])
+                        if nbit != 32:
+                            idata = BFArray(np.asarray(idata).astype(np.int32), dtype='i32', space='system')
                         self.send_packets_bf(idata, baselines, udt, time_tag, desc, chan0, nchan, 0,
                                 upstream_acc_len * samples_per_spectra)
                     else:
                         # Read chan x baseline x complexity input data.
                         # Transpose to baseline x chan x complexity
-                        idata = ispan.data_view('i32').reshape([nchan, nvis, 2]).transpose([1,0,2])
+                        idata = ispan.data_view(idtype).reshape([nchan, nvis, 2]).transpose([1,0,2])
                         # Do an actual copy so that we have binary data formatted for sending
                         dout[...] = idata;
                         self.send_packets_py(dout, baselines, ihdr['sync_time'], this_gulp_time,
@@ -9,10 +9,10 @@ from bifrost.ndarray import copy_array
 from bifrost.device import stream_synchronize, set_device as BFSetGPU
 
 import time
-import ujson as json
+import orjson
 import numpy as np
 
-from .block_base import Block
+from .block_base import Block, COMMAND_OK
 
 class CorrSubsel(Block):
     """
@@ -70,6 +70,10 @@ class CorrSubsel(Block):
         +-------------+----------------+---------+----------------------------------------------------+
         | nchan\_sum  | int            | -       | Number of frequency channels summed by this block  |
         +-------------+----------------+---------+----------------------------------------------------+
+        | nbit        | int            | -       | Number of bits per real/imaginary output value.    |
+        |             |                |         | 32, or 16 if the block was instantiated with       |
+        |             |                |         | ``nbit=16``.                                       |
+        +-------------+----------------+---------+----------------------------------------------------+
         | baselines   | list of ints   | -       | A list of output stand/pols, with dimensions       |
         |             |                |         | ``[nvis, 2, 2]``. E.g. if entry :math:`[V]` of     |
         |             |                |         | this list has value ``[[N_0, P_0], [N_1, P_1]]``   |
@@ -98,6 +102,13 @@ class CorrSubsel(Block):
     ``time x frequency channel x visibility x complexity``.
     The output buffer is written in blocks of ``nchan // nchan_sum x nvis_out[=4704]``
     64-bit words.
+    If the block is instantiated with ``nbit=16``, output data are instead
+    16+16 bit complex integers, saturated at +/-32767, and written in blocks of
+    ``nchan // nchan_sum x nvis_out`` 32-bit words.
+    If the output buffer is in ``cuda`` or ``cuda_host`` (pinned) memory, data are
+    written to it directly by the GPU. If it is in ``system`` memory, data are
+    staged in a GPU buffer and copied out, which is slower since the copy cannot
+    be a direct DMA to pageable memory.
 
     **Instantiation**
 
@@ -142,6 +153,11 @@ class CorrSubsel(Block):
         sequence header entry ``bl_is_conj``.
     :type bl_is_conj: 4D list of bool
 
+    :param nbit: Number of bits per real/imaginary output value. 32 outputs the
+        visibilities losslessly. 16 saturates them to 16+16 bit integers on the GPU,
+        halving the size of the output data stream.
+    :type nbit: int
+
     **Runtime Control and Monitoring**
 
     .. table::
@@ -153,7 +169,8 @@ class CorrSubsel(Block):
         | ``baselines``    | 3D     |         | A list of baselines for      |
         |                  | list   |         | subselection. This field     |
         |                  | of int |         | should be provided as a      |
-        |                  |        |         | multidimensional list with   |
+        |                  |        |         | multidimensional list (or    |
+        |                  |        |         | binary-encoded array) with   |
         |                  |        |         | dimensions ``[nvis, 2, 2]``. |
         |                  |        |         | The first axis runs over the |
         |                  |        |         | 4704 baselines which may be  |
@@ -185,7 +202,7 @@ class CorrSubsel(Block):
     nvis_out = 48 * 49 * 4 // 2 # 48-stand, dual-pol
     def __init__(self, log, iring, oring, guarantee=True, core=-1, etcd_client=None,
                  nchan=192, npol=2, nstand=352, nchan_sum=4, gpu=-1,
-                 antpol_to_bl=None, bl_is_conj=None):
+                 antpol_to_bl=None, bl_is_conj=None, nbit=32):
 
         super(CorrSubsel, self).__init__(log, iring, oring, guarantee, core, etcd_client=etcd_client)
 
@@ -202,35 +219,58 @@ class CorrSubsel(Block):
 
         self.igulp_size = self.matlen * 8 # complex64
 
-        # Create an array of subselection indices on the GPU, and one on the CPU.
-        # The user can update the CPU-side array, and the main processing thread
-        # will copy this to the GPU when it changes
+        # Create an array of subselection indices on the GPU, and two on the CPU.
+        # New selections are computed (by the etcd callback thread, holding the
+        # control lock) into whichever CPU-side array is not being used by the
+        # main processing thread. The main thread switches to the most recently
+        # computed array in update_command_vals (also under the control lock),
+        # and copies it to the GPU.
         # TODO: nvis_out could be dynamic, but we'd have to reallocate the GPU memory
         # if the size changed. Leave static for now, which is all the requirements call for.
         self._subsel      = BFArray(shape=[self.nvis_out], dtype='i32', space='cuda')
-        self._subsel_next = BFArray(shape=[self.nvis_out], dtype='i32', space='cuda_host')
+        self._subsel_next = [BFArray(shape=[self.nvis_out], dtype='i32', space='cuda_host') for i in range(2)]
         self._conj      = BFArray(shape=[self.nvis_out], dtype='i32', space='cuda')
-        self._conj_next = BFArray(shape=[self.nvis_out], dtype='i32', space='cuda_host')
-
+        self._conj_next = [BFArray(shape=[self.nvis_out], dtype='i32', space='cuda_host') for i in range(2)]
+        self._subsel_baselines = [None, None] # The baselines each CPU-side array was computed from
+        self._subsel_ready = 1  # CPU-side array holding the latest selection
+        self._subsel_in_use = 0 # CPU-side array last loaded by the main thread
+        # Descriptors of the fixed GPU allocations, built once rather than per span
+        self._subsel_bf = self._subsel.as_BFarray()
+        self._conj_bf = self._conj.as_BFarray()
+
+        assert nbit in (16, 32), "nbit must be 16 or 32"
+        self.nbit = nbit
         self.obuf_gpu = BFArray(shape=[self.nchan_out, self.nvis_out], dtype='ci32', space='cuda')
-        self.ogulp_size = self.nchan_out * self.nvis_out * 8
+        if self.nbit == 16:
+            # Real/imag values of obuf_gpu, and their saturated 16-bit versions
+            self._obuf_i32 = self.obuf_gpu.view('i32')
+            self.obuf16_gpu = BFArray(shape=[self.nchan_out, 2*self.nvis_out], dtype='i16', space='cuda')
+        self._obuf_bf = self.obuf_gpu.as_BFarray()
+        # If the output ring is GPU-accessible (device memory, or pinned and
+        # mapped host memory) gather directly into it, skipping obuf_gpu and
+        # the copy out of it. obuf_gpu is kept in case this fails.
+        self._direct_output = self.nbit == 32 and self.oring.space in ('cuda', 'cuda_host')
+        self.ogulp_size = self.nchan_out * self.nvis_out * 2 * self.nbit // 8
         self.update_stats()
         if antpol_to_bl is not None:
-            self._antpol_to_bl = antpol_to_bl
+            self._antpol_to_bl = np.asarray(antpol_to_bl)
         else:
             self._antpol_to_bl = np.zeros([nstand, npol, nstand, npol])
         if bl_is_conj is not None:
-            self._bl_is_conj = bl_is_conj
+            self._bl_is_conj = np.asarray(bl_is_conj)
         else:
             self._bl_is_conj = np.zeros([nstand, npol, nstand, npol])
 
         # update subselection map to a default initial value of
         # pol 0 autos
         # This can't be called until the bl_is_conj and antpol_to_bl maps have been set above
-        subsel = [[[i % nstand,0], [i % nstand,0]] for i in range(self.nvis_out)]
+        subsel = np.zeros([self.nvis_out, 2, 2], dtype=np.int32)
+        subsel[:, 0, 0] = np.arange(self.nvis_out) % nstand
+        subsel[:, 1, 0] = subsel[:, 0, 0]
 
-        self.define_command_key('baselines', type=list, initial_val=subsel,
-                                condition=lambda x: len(x) == self.nvis_out)
+        # Baselines may arrive as a list, or as a binary-encoded array
+        self.define_command_key('baselines', type=(list, np.ndarray), initial_val=subsel,
+                                condition=self._check_baselines)
         # Load the subselection indices
         self.update_subsel(subsel)
         
@@ -239,15 +279,147 @@ class CorrSubsel(Block):
         Update the baseline index list which should be subselected.
         Updates are not applied immediately, but are transferred to the
         GPU at the end of the current data block.
+        Once the block is running, this should only be called with the
+        control lock held.
         """
         cpu_affinity.set_core(self.core)
-        for v in range(self.nvis_out):
-            i0, i1 = baselines[v]
-            s0, p0 = i0
-            s1, p1 = i1
-            # index as S0, S1, P0, P1
-            self._subsel_next.data[v] = self._antpol_to_bl[s0, s1, p0, p1]
-            self._conj_next.data[v] = self._bl_is_conj[s0, s1, p0, p1]
+        # Look up all visibilities at once, rather than element by element.
+        # Do this before touching the shared arrays, so that a bad selection
+        # can't leave them partially written.
+        bls = np.asarray(baselines, dtype=np.int32).reshape(self.nvis_out, 2, 2)
+        s0 = bls[:, 0, 0]
+        p0 = bls[:, 0, 1]
+        s1 = bls[:, 1, 0]
+        p1 = bls[:, 1, 1]
+        # index as S0, S1, P0, P1
+        subsel = self._antpol_to_bl[s0, s1, p0, p1]
+        conj = self._bl_is_conj[s0, s1, p0, p1]
+        slot = 1 - self._subsel_in_use
+        np.copyto(np.asarray(self._subsel_next[slot]), subsel, casting='unsafe')
+        np.copyto(np.asarray(self._conj_next[slot]), conj, casting='unsafe')
+        self._subsel_baselines[slot] = bls
+        self._subsel_ready = slot
+
+    def _check_baselines(self, baselines):
+        """
+        Check that a baseline selection has dimensions ``[nvis_out, 2, 2]``
+        and refers only to valid stands and polarizations.
+
+        :return: True if the selection is valid, False otherwise
+        :rtype: bool
+        """
+        try:
+            bls = np.asarray(baselines, dtype=np.int32)
+        except (TypeError, ValueError):
+            return False
+        if bls.shape != (self.nvis_out, 2, 2):
+            return False
+        stands = bls[:, :, 0]
+        pols = bls[:, :, 1]
+        return bool(np.all((stands >= 0) & (stands < self.nstand)) and
+                    np.all((pols >= 0) & (pols < self.npol)))
+
+    def _process_commands(self, command_dict, set_pending_flag=True):
+        """
+        As ``Block._process_commands``, but also compute the subselection
+        indices for any new baseline selection, so that this work
+        happens in the etcd callback thread rather than the main
+        processing thread.
+        """
+        rv = super(CorrSubsel, self)._process_commands(command_dict, set_pending_flag=set_pending_flag)
+        if rv == COMMAND_OK and 'baselines' in command_dict:
+            self.update_subsel(command_dict['baselines'])
+        return rv
+
+    def _subselect(self, idata, odata, check=True):
+        """
+        Run the xGPU subselection kernel on input data ``idata``, writing
+        the result to ``odata``.
+
+        :param check: If True, raise a RuntimeError if the kernel returns
+            an error.
+        :type check: bool
+
+        :return: The bifrost status code returned by the kernel
+        """
+        # Only the input (and, when writing directly to the output ring, the
+        # output) descriptor changes from span to span
+        odata_bf = self._obuf_bf if odata is self.obuf_gpu else odata.as_BFarray()
+        rv = _bf.bfXgpuSubSelect(idata.as_BFarray(), odata_bf, self._subsel_bf, self._conj_bf, self.nchan_sum)
+        if check and (rv != _bf.BF_STATUS_SUCCESS):
+            self.log.error("xgpuSubSelect returned %d" % rv)
+            raise RuntimeError
+        return rv
+
+    def _pack_16bit(self):
+        """
+        Saturate the 32-bit visibilities in ``obuf_gpu`` to 16 bits, writing
+        them to ``obuf16_gpu``.
+        """
+        BFMap("b = min(max(a, -32767), 32767)", data={'a': self._obuf_i32, 'b': self.obuf16_gpu})
+
+    def update_command_vals(self):
+        """
+        As ``Block.update_command_vals``, but also switch to the most
+        recently computed baseline selection, which is loaded to the GPU
+        by ``_load_subsel``.
+        """
+        cpu_affinity.set_core(self.core)
+        self._control_lock.acquire()
+        self.command_vals.update(self._pending_command_vals)
+        self._subsel_in_use = self._subsel_ready
+        self.update_pending = False
+        self.stats['update_pending'] = False
+        self.stats['last_cmd_proc_time'] = time.time()
+        self._control_lock.release()
+        self.update_stats(self.command_vals)
+
+    def _load_subsel(self):
+        """
+        Copy the subselection indices selected by the last call to
+        ``update_command_vals`` to the GPU. The etcd callback thread
+        doesn't write to these until the next call, so no lock is needed.
+
+        :return: The baseline selection which has been loaded, as an
+            ``[nvis, 2, 2]`` integer array
+        """
+        slot = self._subsel_in_use
+        copy_array(self._subsel, self._subsel_next[slot])
+        copy_array(self._conj, self._conj_next[slot])
+        stream_synchronize()
+        return self._subsel_baselines[slot]
+
+    def _begin_output_sequence(self, oring, ohdr_static, seq0, time_tag, nringlet):
+        """
+        Load the latest baseline selection, and begin a new output sequence
+        whose header reflects it.
+
+        :param oring: Output ring, opened for writing
+        :type oring: bifrost.ring.WriteRing
+
+        :param ohdr_static: JSON-encoded output header, without the ``seq0``
+            and ``baselines`` fields
+        :type ohdr_static: bytes
+
+        :param seq0: Spectra number of the first sample in the new sequence
+        :type seq0: int
+
+        :param time_tag: Time tag of the new sequence
+        :type time_tag: int
+
+        :param nringlet: Number of ringlets in the new sequence
+        :type nringlet: int
+
+        :return: The new output sequence
+        """
+        self.log.info("Updating baseline subselection indices")
+        self.update_command_vals()
+        # copy to GPU
+        baselines = self._load_subsel()
+        # orjson encodes the baseline array directly, with no tolist()
+        ohdr_str = ohdr_static[:-1] + b',"seq0":%d,"baselines":' % seq0 \
+                   + orjson.dumps(baselines, option=orjson.OPT_SERIALIZE_NUMPY) + b'}'
+        return oring.begin_sequence(time_tag=time_tag, header=ohdr_str.decode(), nringlet=nringlet)
 
     def main(self):
         cpu_affinity.set_core(self.core)
@@ -260,9 +432,9 @@ class CorrSubsel(Block):
         oseq = None
         time_tag = 1
         with self.oring.begin_writing() as oring:
-            prev_time = time.time()
+            prev_time = time.monotonic_ns()
             for iseq in self.iring.read(guarantee=self.guarantee):
-                ihdr = json.loads(iseq.header.tostring())
+                ihdr = orjson.loads(iseq.header.tostring())
                 this_gulp_time = ihdr['seq0']
                 acc_len = ihdr['acc_len']
                 # Uncomment this if you want to read the map on the fly
@@ -273,42 +445,58 @@ class CorrSubsel(Block):
                 ohdr['nvis'] = self.nvis_out
                 chan_width = ihdr['bw_hz'] / ihdr['nchan']
                 ohdr['sfreq'] = (ihdr['sfreq'] + ((self.nchan_sum - 1) * chan_width)) / self.nchan_sum
-                # On a start of sequence, always grab new subselection
-                self.log.info("Updating baseline subselection indices")
-                self.update_command_vals()
-                self.update_subsel(self.command_vals['baselines'])
-                # copy to GPU
-                copy_array(self._subsel, self._subsel_next)
-                copy_array(self._conj, self._conj_next)
-                ohdr['baselines'] = self.command_vals['baselines']
                 ohdr['nchan_sum'] = self.nchan_sum
-                ohdr_str = json.dumps(ohdr)
-                oseq = oring.begin_sequence(time_tag=time_tag, header=ohdr_str, nringlet=iseq.nringlet)
+                ohdr['nbit'] = self.nbit
+                # Only seq0 and baselines change within an input sequence, so
+                # the rest of the header is encoded once, here
+                ohdr.pop('seq0', None)
+                ohdr.pop('baselines', None)
+                ohdr_static = orjson.dumps(ohdr)
+                # On a start of sequence, always grab new subselection
+                oseq = self._begin_output_sequence(oring, ohdr_static, this_gulp_time, time_tag, iseq.nringlet)
                 time_tag += 1
                 for ispan in iseq.read(self.igulp_size):
-                    curr_time = time.time()
+                    curr_time = time.monotonic_ns()
                     acquire_time = curr_time - prev_time
                     prev_time = curr_time
                     self.log.debug("Grabbing subselection")
                     idata = ispan.data_view('ci32').reshape(self.matlen)
+                    if not self._direct_output:
+                        # Launch the subselection before reserving output space, so that
+                        # the GPU works while we (possibly) wait for downstream blocks
+                        self._subselect(idata, self.obuf_gpu)
+                        if self.nbit == 16:
+                            self._pack_16bit()
                     with oseq.reserve(self.ogulp_size) as ospan:
-                        curr_time = time.time()
+                        curr_time = time.monotonic_ns()
                         reserve_time = curr_time - prev_time
                         prev_time = curr_time
-                        rv = _bf.bfXgpuSubSelect(idata.as_BFarray(), self.obuf_gpu.as_BFarray(), self._subsel.as_BFarray(), self._conj.as_BFarray(), self.nchan_sum)
-                        if (rv != _bf.BF_STATUS_SUCCESS):
-                            self.log.error("xgpuSubSelect returned %d" % rv)
-                            raise RuntimeError
-                        odata = ospan.data_view(dtype='ci32').reshape([self.nchan_out, self.nvis_out])
-                        copy_array(odata, self.obuf_gpu)
-                        # Wait for copy to complete before committing span
+                        if self.nbit == 16:
+                            odata = ospan.data_view(dtype='i16').reshape([self.nchan_out, 2*self.nvis_out])
+                        else:
+                            odata = ospan.data_view(dtype='ci32').reshape([self.nchan_out, self.nvis_out])
+                        if self._direct_output:
+                            # Gather straight into the output span
+                            rv = self._subselect(idata, odata, check=False)
+                            if rv != _bf.BF_STATUS_SUCCESS:
+                                self.log.warning("xgpuSubSelect could not write to %s memory (returned %d). "
+                                                 "Using a GPU staging buffer" % (self.oring.space, rv))
+                                self._direct_output = False
+                                self._subselect(idata, self.obuf_gpu)
+                                copy_array(odata, self.obuf_gpu)
+                        elif self.nbit == 16:
+                            copy_array(odata, self.obuf16_gpu)
+                        else:
+                            copy_array(odata, self.obuf_gpu)
+                        # Wait for GPU to complete before committing span
                         stream_synchronize()
-                        curr_time = time.time()
+                        curr_time = time.monotonic_ns()
                         process_time = curr_time - prev_time
                         prev_time = curr_time
-                    self.perf_proclog.update({'acquire_time': acquire_time, 
-                                              'reserve_time': reserve_time, 
-                                              'process_time': process_time,
+                    # Timings are kept as integer ns, and only converted to seconds here
+                    self.perf_proclog.update({'acquire_time': acquire_time / 1e9, 
+                                              'reserve_time': reserve_time / 1e9, 
+                                              'process_time': process_time / 1e9,
                                               'this_sample' : this_gulp_time})
                     # tick the sequence counter to the next integration
                     this_gulp_time += acc_len
@@ -316,16 +504,8 @@ class CorrSubsel(Block):
                     # with an updated header
                     if self.update_pending:
                         oseq.end()
-                        self.log.info("Updating baseline subselection indices")
-                        self.update_command_vals()
-                        self.udpate_subsel(self.command_vals['baselines'])
-                        copy_array(self._subsel, self._subsel_next)
-                        copy_array(self._conj, self._conj_next)
-                        ohdr['baselines'] = self.command_vals['baselines']
                         #update time tag based on what has already been processed
-                        ohdr['seq0'] = this_gulp_time
-                        ohdr_str = json.dumps(ohdr)
-                        oseq = oring.begin_sequence(time_tag=time_tag, header=ohdr_str, nringlet=iseq.nringlet)
+                        oseq = self._begin_output_sequence(oring, ohdr_static, this_gulp_time, time_tag, iseq.nringlet)
                         time_tag += 1
                 # if the iseq ends
                 oseq.end()
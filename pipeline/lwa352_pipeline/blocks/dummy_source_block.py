@@ -3,12 +3,15 @@ import bifrost.ndarray as BFArray
 import bifrost.affinity as cpu_affinity
 
 import os
+import mmap
 import time
-import ujson as json
+import orjson
 import threading
 import numpy as np
 
 NTEST_BLOCKS = 2
+REPORT_PERIOD = 100 # Gulps between performance reports
+TEST_DTYPE = np.uint8 # Output data type; one 4+4-bit complex sample per byte
 
 class DummySource(object):
     """
@@ -127,10 +130,16 @@ class DummySource(object):
        with each 4+4-bit data sample taking the value ``stand % 8``
     :type skip_write: Bool
 
+    :param rt_priority: If not ``None``, the SCHED_FIFO real-time priority (1-99) with
+       which this block's processing thread should run, to reduce throttling jitter. This
+       requires the ``CAP_SYS_NICE`` capability. If it cannot be set, a warning is
+       emitted and the block runs with normal scheduling.
+    :type rt_priority: int
+
     """
     def __init__(self, log, oring, ntime_gulp=2500,
                  core=-1, nchan=192, nstand=352, npol=2, skip_write=False, 
-                 target_throughput=22.0, testfile=None, header={}):
+                 target_throughput=22.0, testfile=None, header={}, rt_priority=None):
         self.log = log
         self.oring = oring
         self.ntime_gulp = ntime_gulp
@@ -142,6 +151,7 @@ class DummySource(object):
         self.skip_write = skip_write
         self.target_throughput = target_throughput
         self.header_base = header
+        self.rt_priority = rt_priority
         
         self.bind_proclog = ProcLog(type(self).__name__+"/bind")
         self.in_proclog   = ProcLog(type(self).__name__+"/in")
@@ -158,40 +168,81 @@ class DummySource(object):
         if testfile is not None:
             self.testfile = open(testfile, 'rb')
             self.testfile_nbytes = os.path.getsize(testfile)
+            # Map the file, so gulps can be served straight from the page cache
+            self._testfile_mmap = mmap.mmap(self.testfile.fileno(), 0, access=mmap.ACCESS_READ)
+            self._testfile_data = np.frombuffer(self._testfile_mmap, dtype=TEST_DTYPE)
         else:
             self.testfile = None
 
         # make an array ninputs-elements long with [station, pol] IDs.
         # e.g. if input_to_ant[12] = [27, 1], then the 13th input is stand 27, pol 1
-        self.input_to_ant = np.zeros([self.ninputs, 2], dtype=np.int32)
-        for s in range(self.nstand):
-            for p in range(self.npol):
-                self.input_to_ant[self.npol*s + p] = [s, p]
-
-        self.ant_to_input = np.zeros([self.nstand, self.npol], dtype=np.int32)
-        for i, inp in enumerate(self.input_to_ant):
-            stand = inp[0]
-            pol = inp[1]
-            self.ant_to_input[stand, pol] = i
-
-        if skip_write:
-            self.test_data = BFArray(shape=[NTEST_BLOCKS, ntime_gulp, nchan, nstand, npol], dtype='i8', space='system')
+        idx = np.arange(self.ninputs, dtype=np.int32)
+        self.input_to_ant = np.stack([idx // self.npol, idx % self.npol], axis=1)
+        # Input npol*s + p is stand s, pol p, so the inverse map is just a reshape
+        self.ant_to_input = idx.reshape(self.nstand, self.npol).copy()
+
+        # The output header is fixed apart from ``sync_time``, so it is
+        # encoded here, with the (trailing) ``sync_time`` value filled in
+        # by main().
+        hdr = {}
+        hdr.update(self.header_base)
+        hdr.pop('sync_time', None)
+        hdr['nchan'] = self.nchan
+        hdr['system_nchan'] = 32*self.nchan
+        hdr['chan0'] = 0
+        hdr['bw_hz'] = 24e3 * self.nchan
+        hdr['fs_hz'] = 196608000
+        hdr['sfreq'] = 0.0
+        hdr['nstand'] = self.nstand
+        hdr['npol'] = self.npol
+        hdr['seq0'] = 0
+        hdr['input_to_ant'] = self.input_to_ant
+        hdr['ant_to_input'] = self.ant_to_input
+        # orjson encodes the input/antenna map arrays directly, without
+        # building them as Python lists first
+        self._hdr_prefix = orjson.dumps(hdr, option=orjson.OPT_SERIALIZE_NUMPY)[:-1] + b',"sync_time":'
+        self.bytes_per_report = REPORT_PERIOD * self.gulp_size
+
+        # Test data are allocated (and first touched) by _init_test_data,
+        # called from main() once this block's thread is bound to its core,
+        # so that the memory is local to that core.
+        self.gulp_shape = (ntime_gulp, nchan, nstand, npol)
+        self.test_data = None
+
+        self.shutdown_event = threading.Event()
+
+    def _init_test_data(self):
+        """
+        Allocate and fill the test data buffers. These aren't needed when
+        data are read from a test file, so nothing is allocated in that case.
+        """
+        if self.testfile:
+            self._test_data_views = ()
+            return
+        shape = (NTEST_BLOCKS,) + self.gulp_shape
+        if self.skip_write:
+            self.test_data = BFArray(shape=shape, dtype='i8', space='system')
         else:
             #print("initializing random numbers")
             #TODO Can't get 'ci4' type to behave
-            #self.test_data = BFArray(np.random.randint(0, high=255, size=[NTEST_BLOCKS, ntime_gulp, nchan, nstand, npol]),
+            #self.test_data = BFArray(np.random.randint(0, high=255, size=shape),
             #                    dtype='u8', space='system')
-            self.test_data = BFArray(np.zeros([NTEST_BLOCKS, ntime_gulp, nchan, nstand, npol]),
-                                dtype='u8', space='system')
-            for i in range(nstand):
-                self.test_data[:,:,:,i,:] = i%8
-
-        self.shutdown_event = threading.Event()
+            self.test_data = BFArray(shape=shape, dtype='u8', space='system')
+            # Ramp with value stand % 8, written in a single broadcast pass
+            ramp = (np.arange(self.nstand) % 8).astype(np.uint8)
+            self.test_data[...] = ramp.reshape(1, 1, 1, self.nstand, 1)
+        # Plain numpy views of each test block, for fast copies into the output span
+        self._test_data_views = tuple(np.asarray(self.test_data[i]) for i in range(NTEST_BLOCKS))
 
     def get_test_data(self):
-        r = self.test_data >> 4
-        i = self.test_data & 0xf
-        return r + 1j*i
+        """
+        Return the test data, unpacked to complex64.
+        """
+        x = np.asarray(self.test_data)
+        out = np.empty(x.shape, dtype=np.complex64)
+        out.real = x >> 4
+        out.imag = x & 0xf
+        return out
 
     def shutdown(self):
         self.shutdown_event.set()
@@ -203,74 +254,90 @@ class DummySource(object):
         the end is reached.
         Inputs: t (int) -- time index of gulp. I.e., increment
             by 1 between gulps.
+        Returns a read-only view of the (memory-mapped) file.
         """
         nbytes = self.gulp_size
         seekloc = (self.gulp_size * t) % self.testfile_nbytes
-        self.testfile.seek(seekloc)
-        rawdata = self.testfile.read(nbytes)
-        if len(rawdata) != nbytes:
+        if seekloc + nbytes > self.testfile_nbytes:
             self.log.error("Failed to get input test vector gulp")
-            return np.zeros_like(self.test_data[1:])
-        return np.frombuffer(rawdata, dtype=np.uint8).reshape(self.test_data.shape[1:])
+            return np.zeros(self.gulp_shape, dtype=TEST_DTYPE)
+        if hasattr(os, 'posix_fadvise'):
+            # Ask the kernel to start reading the next gulp in the background
+            nextloc = (seekloc + nbytes) % self.testfile_nbytes
+            os.posix_fadvise(self.testfile.fileno(), nextloc, nbytes, os.POSIX_FADV_WILLNEED)
+        return self._testfile_data[seekloc:seekloc + nbytes].reshape(self.gulp_shape)
 
     def main(self):
         cpu_affinity.set_core(self.core)
         self.bind_proclog.update({'ncore': 1, 
                                   'core0': cpu_affinity.get_core(),})
+        if self.rt_priority is not None:
+            try:
+                os.sched_setscheduler(0, os.SCHED_FIFO, os.sched_param(self.rt_priority))
+            except (OSError, AttributeError):
+                self.log.warning("Could not set real-time priority %d. Using default scheduling" % self.rt_priority)
+        self._init_test_data()
 
         time.sleep(0.1)
         self.oring.resize(self.gulp_size, self.gulp_size*4)
-        hdr = {}
-        hdr.update(self.header_base)
-        hdr['nchan'] = self.nchan
-        hdr['system_nchan'] = 32*self.nchan
-        hdr['chan0'] = 0
-        hdr['bw_hz'] = 24e3 * self.nchan
-        hdr['fs_hz'] = 196608000
-        hdr['sfreq'] = 0.0
-        hdr['nstand'] = self.nstand
-        hdr['npol'] = self.npol
-        hdr['seq0'] = 0
-        hdr['input_to_ant'] = self.input_to_ant.tolist()
-        hdr['ant_to_input'] = self.ant_to_input.tolist()
-        hdr['sync_time'] = int(time.time())
+        sync_time = int(time.time())
         time_tag = 0
-        REPORT_PERIOD = 100
-        bytes_per_report = REPORT_PERIOD * self.gulp_size
+        bytes_per_report = self.bytes_per_report
         acquire_time = 0 # this block doesn't have an input ring
         gbps = 0
-        extra_delay = 0
+        # Output is paced against absolute per-gulp deadlines
+        gulp_period_ns = int(8 * self.gulp_size / self.target_throughput)
+        oshape = self.gulp_shape
+        odtype = TEST_DTYPE
+        # Per-gulp timings are accumulated (in integer ns) and only published
+        # to the perf proclog once every REPORT_PERIOD gulps
+        reserve_time_ns = 0
+        process_time_ns = 0
         with self.oring.begin_writing() as oring:
-            tick = time.time()
-            ohdr_str = json.dumps(hdr)
-            prev_time = time.time()
+            tick = time.monotonic_ns()
+            ohdr_str = (self._hdr_prefix + b'%d}' % sync_time).decode()
+            prev_time = time.monotonic_ns()
+            deadline = prev_time
             with oring.begin_sequence(time_tag=time_tag, header=ohdr_str) as oseq:
                 while not self.shutdown_event.is_set():
                     with oseq.reserve(self.gulp_size) as ospan:
-                        curr_time = time.time()
-                        reserve_time = curr_time - prev_time
+                        curr_time = time.monotonic_ns()
+                        reserve_time_ns += curr_time - prev_time
                         prev_time = curr_time
                         if not self.skip_write:
+                            odata = ospan.data_view(shape=oshape, dtype=odtype)
                             if self.testfile:
-                                self.test_data[time_tag % NTEST_BLOCKS] = self.get_testfile_gulp(time_tag)
-                            odata = ospan.data_view(shape=self.test_data.shape[1:], dtype=self.test_data.dtype)
-                            odata[...] = self.test_data[time_tag % NTEST_BLOCKS]
+                                # Copy test file data straight from the file mapping,
+                                # without staging it in test_data. The view isn't
+                                # kept, so the mapping can be closed at shutdown.
+                                np.copyto(odata, self.get_testfile_gulp(time_tag))
+                            else:
+                                np.copyto(odata, self._test_data_views[time_tag % NTEST_BLOCKS])
                         time_tag += 1
-                    curr_time = time.time()
-                    process_time = curr_time - prev_time
+                    curr_time = time.monotonic_ns()
+                    process_time_ns += curr_time - prev_time
                     prev_time = curr_time
-                    self.perf_proclog.update({'acquire_time': acquire_time, 
-                                              'reserve_time': reserve_time, 
-                                              'process_time': process_time,
-                                              'gbps' : gbps})
-                    time.sleep(max(0, extra_delay / REPORT_PERIOD))
+                    deadline += gulp_period_ns
+                    if curr_time < deadline:
+                        time.sleep((deadline - curr_time) / 1e9)
+                    else:
+                        # Running behind. Don't try to catch up with a burst.
+                        deadline = curr_time
                     if time_tag % REPORT_PERIOD == 0:
-                        tock = time.time()
-                        dt = tock - tick
+                        tock = time.monotonic_ns()
+                        dt = (tock - tick) / 1e9
                         gbps = 8*bytes_per_report / dt / 1e9
                         self.log.info('%d: Sent %d bytes in %.2f seconds (%.2f Gb/s)' % (time_tag // REPORT_PERIOD, bytes_per_report, dt, gbps))
-                        target_time = 8*bytes_per_report / self.target_throughput / 1e9
-                        extra_delay = target_time - dt + extra_delay
                         tick = tock
+                        # Report the mean per-gulp times over this period
+                        self.perf_proclog.update({'acquire_time': acquire_time, 
+                                                  'reserve_time': reserve_time_ns / REPORT_PERIOD / 1e9, 
+                                                  'process_time': process_time_ns / REPORT_PERIOD / 1e9,
+                                                  'gbps' : gbps})
+                        reserve_time_ns = 0
+                        process_time_ns = 0
         if self.testfile:
+            # The mapping can only be closed once no arrays reference it
+            self._testfile_data = None
+            self._testfile_mmap.close()
             self.testfile.close()
@@ -32,7 +32,7 @@ setuptools.setup(
         "License :: OSI Approved :: MIT License",
         "Operating System :: Ubuntu 18.04",
     ],
-    python_requires='>=3.5',
+    python_requires='>=3.8',
     install_requires=install_requires,
 )
 